@@ -93,6 +93,26 @@ options:
         Then C(hdfs_creates) and C(hdfs_removes) will be performed on behalf of the user defined by the Kerberos ticket."
     required: false
     default: "hdfs"
+  http_pool_connections:
+    description:
+      - Number of hosts (Namenode and Datanodes) for which a pool of kept-alive HTTP connections is maintained.
+    required: false
+    default: 10
+  http_pool_maxsize:
+    description:
+      - Maximum number of kept-alive HTTP connections retained in each host pool.
+    required: false
+    default: 10
+  connect_timeout:
+    description:
+      - Maximum time (in seconds) to establish a connection to the Namenode.
+    required: false
+    default: 10
+  read_timeout:
+    description:
+      - Maximum time (in seconds) to wait for the Namenode to answer (Or between two parts of a long answer).
+    required: false
+    default: 60
 notes:
     -  If you want to run a command through the shell (say you are using C(<),
        C(>), C(|), etc), you actually need to set uses_shell=true. The
@@ -180,8 +200,14 @@ def error(message, *args):
 class WebHDFS:
     
     
-    def __init__(self, endpoint, hdfsUser):
+    def __init__(self, endpoint, hdfsUser, poolConnections, poolMaxsize, timeout):
         self.endpoint = endpoint
+        # Shared keep-alive connection pools. One pool per host (Namenode and each Datanode)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=poolConnections, pool_maxsize=poolMaxsize)
+        self.session.mount("http://", adapter)
+        # (connect, read) timeouts of each request, in seconds
+        self.timeout = timeout
         self.delegationToken = None
         self.auth = None
         if hdfsUser == "KERBEROS":
@@ -198,7 +224,7 @@ class WebHDFS:
             if self.kerberos:
                 kerberos_auth = HTTPKerberosAuth()
                 url = "http://{0}/webhdfs/v1/?op=GETDELEGATIONTOKEN".format(self.endpoint)
-                resp = requests.get(url, auth=kerberos_auth)
+                resp = self.session.get(url, auth=kerberos_auth, timeout=self.timeout)
                 if resp.status_code == 200:
                     result = resp.json()
                     self.delegationToken = result['Token']['urlString']
@@ -210,7 +236,7 @@ class WebHDFS:
                     return (False, "{0}  =>  Response code: {1}".format(url, resp.status_code))
             else:
                 url = "http://{0}/webhdfs/v1/?{1}op=GETFILESTATUS".format(self.endpoint, self.auth)
-                resp = requests.get(url)
+                resp = self.session.get(url, timeout=self.timeout)
                 if resp.status_code == 200:
                     return (True, "")
                 elif resp.status_code == 401:
@@ -228,15 +254,28 @@ class WebHDFS:
         if self.kerberos and self.delegationToken != None:
             url = "http://{0}/webhdfs/v1/?{1}op=CANCELDELEGATIONTOKEN&token={2}".format(self.endpoint, self.auth, self.delegationToken)
             self.put(url)
+        self.session.close()
+
+    def getConnectionStats(self):
+        # urllib3 maintains per host counters. Each request which did not open a new connection reused a kept-alive one.
+        stats = { 'requests': 0, 'connections': 0 }
+        for adapter in self.session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats['requests'] += pool.num_requests
+                stats['connections'] += pool.num_connections
+        stats['reused_connections'] = stats['requests'] - stats['connections']
+        return stats
             
     def put(self, url):
-        resp = requests.put(url, allow_redirects=False)
+        resp = self.session.put(url, allow_redirects=False, timeout=self.timeout)
         if resp.status_code != 200:  
             error("Invalid returned http code '{0}' when calling '{1}'", resp.status_code, url)
         
     def getFileStatus(self, path):
         url = "http://{0}/webhdfs/v1{1}?{2}op=GETFILESTATUS".format(self.endpoint, path, self.auth)
-        resp = requests.get(url)
+        resp = self.session.get(url, timeout=self.timeout)
         if resp.status_code == 200:
             #print content
             result = resp.json()
@@ -269,7 +308,7 @@ def lookupWebHdfs(p):
                 error("Unable to find {0}* or {1}* in {2}. Provide explicit 'webhdfs_endpoint'", NN_HTTP_TOKEN1, NN_HTTP_TOKEN2, hspath)
             errors = []
             for endpoint in candidates:
-                webHDFS= WebHDFS(endpoint, p.hdfsUser)
+                webHDFS= WebHDFS(endpoint, p.hdfsUser, p.httpPoolConnections, p.httpPoolMaxsize, (p.connectTimeout, p.readTimeout))
                 (x, err) = webHDFS.test()
                 if x:
                     p.webhdfsEndpoint = webHDFS.endpoint
@@ -283,7 +322,7 @@ def lookupWebHdfs(p):
         candidates = p.webhdfsEndpoint.split(",")
         errors = []
         for endpoint in candidates:
-            webHDFS= WebHDFS(endpoint, p.hdfsUser)
+            webHDFS= WebHDFS(endpoint, p.hdfsUser, p.httpPoolConnections, p.httpPoolMaxsize, (p.connectTimeout, p.readTimeout))
             (x, err) = webHDFS.test()
             if x:
                 p.webhdfsEndpoint = webHDFS.endpoint
@@ -310,7 +349,11 @@ def main():
             # -------------- HDFS ADD ON
             hadoop_conf_dir = dict(required=False, default="/etc/hadoop/conf"), 
             webhdfs_endpoint = dict(required=False, default=None),
-            hdfs_user = dict(required=False, default="hdfs")
+            hdfs_user = dict(required=False, default="hdfs"),
+            http_pool_connections = dict(required=False, type='int', default=10),
+            http_pool_maxsize = dict(required=False, type='int', default=10),
+            connect_timeout = dict(required=False, type='int', default=10),
+            read_timeout = dict(required=False, type='int', default=60)
             # -------------- End of HDFS ADD ON
         )
     )
@@ -339,6 +382,10 @@ def main():
     p.hadoopConfDir = module.params['hadoop_conf_dir']
     p.webhdfsEndpoint = module.params['webhdfs_endpoint']
     p.hdfsUser = module.params['hdfs_user']
+    p.httpPoolConnections = module.params['http_pool_connections']
+    p.httpPoolMaxsize = module.params['http_pool_maxsize']
+    p.connectTimeout = module.params['connect_timeout']
+    p.readTimeout = module.params['read_timeout']
     p.changed = False
    
    
@@ -356,7 +403,8 @@ def main():
                 stdout="skipped, since %s exists on HDFS" % hdfs_creates,
                 changed=False,
                 stderr=False,
-                rc=0
+                rc=0,
+                webhdfs_stats=webhdfs.getConnectionStats()
             )
 
     if hdfs_removes:
@@ -370,7 +418,8 @@ def main():
                 stdout="skipped, since %s does not exist on HDFS" % hdfs_removes,
                 changed=False,
                 stderr=False,
-                rc=0
+                rc=0,
+                webhdfs_stats=webhdfs.getConnectionStats()
             )
     # -------------------------------------------------------------------- End of HDFS ADD ON
 
@@ -389,6 +438,7 @@ def main():
     if err is None:
         err = ''
 
+    stats = webhdfs.getConnectionStats()
     cleanup()
     module.exit_json(
         cmd      = cmd,
@@ -398,7 +448,8 @@ def main():
         start    = str(startd),
         end      = str(endd),
         delta    = str(delta),
-        changed  = True
+        changed  = True,
+        webhdfs_stats = stats
     )
 
 # import module snippets
@@ -99,6 +99,26 @@ options:
       Then HDFS operation will be performed on behalf of the user defined by the Kerberos ticket.
     required: false
     default: "hdfs"
+  http_pool_connections:
+    description:
+      - Number of hosts (Namenode and Datanodes) for which a pool of kept-alive HTTP connections is maintained.
+    required: false
+    default: 10
+  http_pool_maxsize:
+    description:
+      - Maximum number of kept-alive HTTP connections retained in each host pool.
+    required: false
+    default: 10
+  connect_timeout:
+    description:
+      - Maximum time (in seconds) to establish a connection to the Namenode.
+    required: false
+    default: 10
+  read_timeout:
+    description:
+      - Maximum time (in seconds) to wait for the Namenode to answer (Or between two parts of a long answer).
+    required: false
+    default: 60
 author: 
     - Serge ALEXANDRE
     
@@ -154,8 +174,14 @@ module = None
 
 class WebHDFS:
     
-    def __init__(self, endpoint, hdfsUser):
+    def __init__(self, endpoint, hdfsUser, poolConnections, poolMaxsize, timeout):
         self.endpoint = endpoint
+        # Shared keep-alive connection pools. One pool per host (Namenode and each Datanode)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=poolConnections, pool_maxsize=poolMaxsize)
+        self.session.mount("http://", adapter)
+        # (connect, read) timeouts of each request, in seconds
+        self.timeout = timeout
         self.delegationToken = None
         self.auth = None
         if hdfsUser == "KERBEROS":
@@ -172,7 +198,7 @@ class WebHDFS:
             if self.kerberos:
                 kerberos_auth = HTTPKerberosAuth()
                 url = "http://{0}/webhdfs/v1/?op=GETDELEGATIONTOKEN".format(self.endpoint)
-                resp = requests.get(url, auth=kerberos_auth)
+                resp = self.session.get(url, auth=kerberos_auth, timeout=self.timeout)
                 if resp.status_code == 200:
                     result = resp.json()
                     self.delegationToken = result['Token']['urlString']
@@ -184,7 +210,7 @@ class WebHDFS:
                     return (False, "{0}  =>  Response code: {1}".format(url, resp.status_code))
             else:
                 url = "http://{0}/webhdfs/v1/?{1}op=GETFILESTATUS".format(self.endpoint, self.auth)
-                resp = requests.get(url)
+                resp = self.session.get(url, timeout=self.timeout)
                 if resp.status_code == 200:
                     return (True, "")
                 elif resp.status_code == 401:
@@ -202,11 +228,24 @@ class WebHDFS:
         if self.kerberos and self.delegationToken != None:
             url = "http://{0}/webhdfs/v1/?{1}op=CANCELDELEGATIONTOKEN&token={2}".format(self.endpoint, self.auth, self.delegationToken)
             self.put(url)
+        self.session.close()
+
+    def getConnectionStats(self):
+        # urllib3 maintains per host counters. Each request which did not open a new connection reused a kept-alive one.
+        stats = { 'requests': 0, 'connections': 0 }
+        for adapter in self.session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats['requests'] += pool.num_requests
+                stats['connections'] += pool.num_connections
+        stats['reused_connections'] = stats['requests'] - stats['connections']
+        return stats
       
 
     def getFileStatus(self, path):
         url = "http://{0}/webhdfs/v1{1}?{2}op=GETFILESTATUS".format(self.endpoint, path, self.auth)
-        resp = requests.get(url)
+        resp = self.session.get(url, timeout=self.timeout)
         if resp.status_code == 200:
             #print content
             result =  resp.json()
@@ -217,7 +256,7 @@ class WebHDFS:
             error("Invalid returned http code '{0}' when calling '{1}'",resp.status_code, url)
             
     def put(self, url):
-        resp = requests.put(url, allow_redirects=False)
+        resp = self.session.put(url, allow_redirects=False, timeout=self.timeout)
         if resp.status_code != 200:  
             error("Invalid returned http code '{0}' when calling '{1}'", resp.status_code, url)
 
@@ -228,12 +267,12 @@ class WebHDFS:
             url = "http://{0}/webhdfs/v1{1}?{2}op=MKDIRS".format(self.endpoint, path, self.auth)
         self.put(url)
 
-    def setOwner(self, path, owner):
-        url = "http://{0}/webhdfs/v1{1}?{2}op=SETOWNER&owner={3}".format(self.endpoint, path, self.auth, owner)
-        self.put(url)
-
-    def setGroup(self, path, group):
-        url = "http://{0}/webhdfs/v1{1}?{2}op=SETOWNER&group={3}".format(self.endpoint, path, self.auth, group)
+    def setOwner(self, path, owner, group):
+        url = "http://{0}/webhdfs/v1{1}?{2}op=SETOWNER".format(self.endpoint, path, self.auth)
+        if owner != None:
+            url = url + "&owner=" + owner
+        if group != None:
+            url = url + "&group=" + group
         self.put(url)
     
     def setPermission(self, path, permission):
@@ -242,7 +281,7 @@ class WebHDFS:
     
     def delete(self, path):
         url = "http://{0}/webhdfs/v1{1}?{2}op=DELETE&recursive=true".format(self.endpoint, path, self.auth)
-        resp = requests.delete(url)
+        resp = self.session.delete(url, timeout=self.timeout)
         if resp.status_code != 200:  
             error("Invalid returned http code '{0}' when calling '{1}'", resp.status_code, url)
         
@@ -274,16 +313,19 @@ class Parameters:
 
 
 def checkAndAdjustAttributes(webhdfs, fileStatus, p):
-    if p.owner != None and p.owner != fileStatus['owner']:
-        p.changed = True
-        if not p.checkMode: 
-            webhdfs.setOwner(p.path, p.owner)
-    if p.group != None and p.group != fileStatus['group']:
+    # Owner and group are set in a single SETOWNER call
+    owner = p.owner if p.owner != None and p.owner != fileStatus['owner'] else None
+    group = p.group if p.group != None and p.group != fileStatus['group'] else None
+    if owner != None or group != None:
         p.changed = True
+        p.rpcPlanned += 1
+        p.rpcNaive += (owner != None) + (group != None)
         if not p.checkMode: 
-            webhdfs.setGroup(p.path, p.group)
+            webhdfs.setOwner(p.path, owner, group)
     if(p.mode != None and fileStatus['permission'] != p.mode):
         p.changed = True
+        p.rpcPlanned += 1
+        p.rpcNaive += 1
         if not p.checkMode: 
             webhdfs.setPermission(p.path, p.mode)
 
@@ -326,7 +368,7 @@ def lookupWebHdfs(p):
                 error("Unable to find {0}* or {1}* in {2}. Provide explicit 'webhdfs_endpoint'", NN_HTTP_TOKEN1, NN_HTTP_TOKEN2, hspath)
             errors = []
             for endpoint in candidates:
-                webHDFS= WebHDFS(endpoint, p.hdfsUser)
+                webHDFS= WebHDFS(endpoint, p.hdfsUser, p.httpPoolConnections, p.httpPoolMaxsize, (p.connectTimeout, p.readTimeout))
                 (x, err) = webHDFS.test()
                 if x:
                     p.webhdfsEndpoint = webHDFS.endpoint
@@ -340,7 +382,7 @@ def lookupWebHdfs(p):
         candidates = p.webhdfsEndpoint.split(",")
         errors = []
         for endpoint in candidates:
-            webHDFS= WebHDFS(endpoint, p.hdfsUser)
+            webHDFS= WebHDFS(endpoint, p.hdfsUser, p.httpPoolConnections, p.httpPoolMaxsize, (p.connectTimeout, p.readTimeout))
             (x, err) = webHDFS.test()
             if x:
                 p.webhdfsEndpoint = webHDFS.endpoint
@@ -363,7 +405,11 @@ def main():
             force = dict(required=False, type='bool', default=True),
             hadoop_conf_dir = dict(required=False, default="/etc/hadoop/conf"),
             webhdfs_endpoint = dict(required=False, default=None),
-            hdfs_user = dict(required=False, default="hdfs")
+            hdfs_user = dict(required=False, default="hdfs"),
+            http_pool_connections = dict(required=False, type='int', default=10),
+            http_pool_maxsize = dict(required=False, type='int', default=10),
+            connect_timeout = dict(required=False, type='int', default=10),
+            read_timeout = dict(required=False, type='int', default=60)
         ),
         supports_check_mode=True
     )
@@ -382,8 +428,14 @@ def main():
     p.hadoopConfDir = module.params['hadoop_conf_dir']
     p.webhdfsEndpoint = module.params['webhdfs_endpoint']
     p.hdfsUser = module.params['hdfs_user']
+    p.httpPoolConnections = module.params['http_pool_connections']
+    p.httpPoolMaxsize = module.params['http_pool_maxsize']
+    p.connectTimeout = module.params['connect_timeout']
+    p.readTimeout = module.params['read_timeout']
     p.checkMode = module.check_mode
     p.changed = False
+    p.rpcPlanned = 0
+    p.rpcNaive = 0
 
 
     if p.mode != None:
@@ -412,12 +464,14 @@ def main():
             error("This module can only create Folder. State should be 'directory' and not '{0}'", p.state)
         else:
             p.changed = True
+            p.rpcPlanned += 1
+            p.rpcNaive += 1 + (p.owner != None) + (p.group != None)
+            if p.owner != None or p.group != None:
+                p.rpcPlanned += 1
             if not p.checkMode:
                 webhdfs.createFolder(p.path, p.mode)
-                if p.owner != None:
-                    webhdfs.setOwner(p.path, p.owner)
-                if p.group != None:
-                    webhdfs.setGroup(p.path, p.group)
+                if p.owner != None or p.group != None:
+                    webhdfs.setOwner(p.path, p.owner, p.group)
     else:
         if p.state == None:
             checkAndAdjustAttributes(webhdfs, fileStatus, p)
@@ -440,8 +494,9 @@ def main():
     if not p.checkMode:
         checkCompletion(webhdfs, p)    
     
+    stats = webhdfs.getConnectionStats()
     cleanup()
-    module.exit_json(changed=p.changed)
+    module.exit_json(changed=p.changed, webhdfs_stats=stats, rpc_plan={ 'planned': p.rpcPlanned, 'saved': p.rpcNaive - p.rpcPlanned })
 
 from ansible.module_utils.basic import *
 if __name__ == '__main__':
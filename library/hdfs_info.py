@@ -62,6 +62,26 @@ options:
       Then HDFS operation will be performed on behalf of the user defined by the Kerberos ticket.
     required: false
     default: "hdfs"
+  http_pool_connections:
+    description:
+      - Number of hosts (Namenode and Datanodes) for which a pool of kept-alive HTTP connections is maintained.
+    required: false
+    default: 10
+  http_pool_maxsize:
+    description:
+      - Maximum number of kept-alive HTTP connections retained in each host pool.
+    required: false
+    default: 10
+  connect_timeout:
+    description:
+      - Maximum time (in seconds) to establish a connection to the Namenode.
+    required: false
+    default: 10
+  read_timeout:
+    description:
+      - Maximum time (in seconds) to wait for the Namenode to answer (Or between two parts of a long answer).
+    required: false
+    default: 60
 author: 
     - Serge ALEXANDRE
     
@@ -119,6 +139,11 @@ modificationTime:
     returned: always
     type: integer
     sample: 1483097882
+webhdfs_stats:
+    description: WebHDFS HTTP connections usage (requests, connections opened and reused_connections)
+    returned: always
+    type: dict
+    sample: { "requests": 2, "connections": 1, "reused_connections": 1 }
 '''
 
 HAS_REQUESTS = False
@@ -143,8 +168,14 @@ module = None
 
 class WebHDFS:
       
-    def __init__(self, endpoint, hdfsUser):
+    def __init__(self, endpoint, hdfsUser, poolConnections, poolMaxsize, timeout):
         self.endpoint = endpoint
+        # Shared keep-alive connection pools. One pool per host (Namenode and each Datanode)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=poolConnections, pool_maxsize=poolMaxsize)
+        self.session.mount("http://", adapter)
+        # (connect, read) timeouts of each request, in seconds
+        self.timeout = timeout
         self.delegationToken = None
         self.auth = None
         if hdfsUser == "KERBEROS":
@@ -161,7 +192,7 @@ class WebHDFS:
             if self.kerberos:
                 kerberos_auth = HTTPKerberosAuth()
                 url = "http://{0}/webhdfs/v1/?op=GETDELEGATIONTOKEN".format(self.endpoint)
-                resp = requests.get(url, auth=kerberos_auth)
+                resp = self.session.get(url, auth=kerberos_auth, timeout=self.timeout)
                 if resp.status_code == 200:
                     result = resp.json()
                     self.delegationToken = result['Token']['urlString']
@@ -173,7 +204,7 @@ class WebHDFS:
                     return (False, "{0}  =>  Response code: {1}".format(url, resp.status_code))
             else:
                 url = "http://{0}/webhdfs/v1/?{1}op=GETFILESTATUS".format(self.endpoint, self.auth)
-                resp = requests.get(url)
+                resp = self.session.get(url, timeout=self.timeout)
                 if resp.status_code == 200:
                     return (True, "")
                 elif resp.status_code == 401:
@@ -191,17 +222,30 @@ class WebHDFS:
         if self.kerberos and self.delegationToken != None:
             url = "http://{0}/webhdfs/v1/?{1}op=CANCELDELEGATIONTOKEN&token={2}".format(self.endpoint, self.auth, self.delegationToken)
             self.put(url)
+        self.session.close()
+
+    def getConnectionStats(self):
+        # urllib3 maintains per host counters. Each request which did not open a new connection reused a kept-alive one.
+        stats = { 'requests': 0, 'connections': 0 }
+        for adapter in self.session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats['requests'] += pool.num_requests
+                stats['connections'] += pool.num_connections
+        stats['reused_connections'] = stats['requests'] - stats['connections']
+        return stats
       
             
     def put(self, url):
-        resp = requests.put(url, allow_redirects=False)
+        resp = self.session.put(url, allow_redirects=False, timeout=self.timeout)
         if resp.status_code != 200:  
             error("Invalid returned http code '{0}' when calling '{1}'", resp.status_code, url)
 
         
     def getFileStatus(self, path):
         url = "http://{0}/webhdfs/v1{1}?{2}op=GETFILESTATUS".format(self.endpoint, path, self.auth)
-        resp = requests.get(url)
+        resp = self.session.get(url, timeout=self.timeout)
         if resp.status_code == 200:
             #print content
             result = resp.json()
@@ -257,7 +301,7 @@ def lookupWebHdfs(p):
                 error("Unable to find {0}* or {1}* in {2}. Provide explicit 'webhdfs_endpoint'", NN_HTTP_TOKEN1, NN_HTTP_TOKEN2, hspath)
             errors = []
             for endpoint in candidates:
-                webHDFS= WebHDFS(endpoint, p.hdfsUser)
+                webHDFS= WebHDFS(endpoint, p.hdfsUser, p.httpPoolConnections, p.httpPoolMaxsize, (p.connectTimeout, p.readTimeout))
                 (x, err) = webHDFS.test()
                 if x:
                     p.webhdfsEndpoint = webHDFS.endpoint
@@ -271,7 +315,7 @@ def lookupWebHdfs(p):
         candidates = p.webhdfsEndpoint.split(",")
         errors = []
         for endpoint in candidates:
-            webHDFS= WebHDFS(endpoint, p.hdfsUser)
+            webHDFS= WebHDFS(endpoint, p.hdfsUser, p.httpPoolConnections, p.httpPoolMaxsize, (p.connectTimeout, p.readTimeout))
             (x, err) = webHDFS.test()
             if x:
                 p.webhdfsEndpoint = webHDFS.endpoint
@@ -290,8 +334,11 @@ def main():
             hdfs_path  = dict(required=True),
             hadoop_conf_dir = dict(required=False, default="/etc/hadoop/conf"),
             webhdfs_endpoint = dict(required=False, default=None),
-            hdfs_user = dict(required=False, default="hdfs")
-            
+            hdfs_user = dict(required=False, default="hdfs"),
+            http_pool_connections = dict(required=False, type='int', default=10),
+            http_pool_maxsize = dict(required=False, type='int', default=10),
+            connect_timeout = dict(required=False, type='int', default=10),
+            read_timeout = dict(required=False, type='int', default=60)
         )
     )
     
@@ -304,6 +351,10 @@ def main():
     p.hadoopConfDir = module.params['hadoop_conf_dir']
     p.webhdfsEndpoint = module.params['webhdfs_endpoint']
     p.hdfsUser = module.params['hdfs_user']
+    p.httpPoolConnections = module.params['http_pool_connections']
+    p.httpPoolMaxsize = module.params['http_pool_maxsize']
+    p.connectTimeout = module.params['connect_timeout']
+    p.readTimeout = module.params['read_timeout']
     p.changed = False
 
 
@@ -315,13 +366,15 @@ def main():
     
     fileStatus = webhdfs.getFileStatus(p.path)
     # NB: Need to set hdfs_path. If setting 'path', module.exit_json will add a 'state' referring to local file status.
+    stats = webhdfs.getConnectionStats()
     cleanup()
     if fileStatus == None:
         module.exit_json(
             changed = False,
             hdfs_path = p.path,
             exists = False,
-            type = "absent"
+            type = "absent",
+            webhdfs_stats = stats
         )
     else:
         module.exit_json(
@@ -334,7 +387,8 @@ def main():
             mode = "0" + fileStatus['permission'],
             int_mode = int(fileStatus['permission'], 8),
             modificationTime = fileStatus['modificationTime']/1000,
-            size = fileStatus['length']
+            size = fileStatus['length'],
+            webhdfs_stats = stats
         )
 
     
@@ -55,6 +55,22 @@ options:
     required: false
     choices: [ "yes", "no" ]
     default: "no"
+  backup_mode:
+    description:
+      - How C(backup) is performed. With C(rename), each replaced file is renamed with a timestamp suffix.
+      - With C(snapshot), a single snapshot (C(hdfs_put-backup-<timestamp>)) of the target directory (of the directory holding
+        the target file, if src is a file) is taken before the first file is replaced, appended or deleted. This directory must be snapshottable
+        (C(hdfs dfsadmin -allowSnapshot)). Previous versions are then in C(<directory>/.snapshot/). With C(pipelined), the snapshot
+        is taken before the first copy of a directory where a file is to be replaced.
+    required: false
+    choices: [ "rename", "snapshot" ]
+    default: "rename"
+  backup_snapshots:
+    description:
+      - With C(backup_mode=snapshot), number of backup snapshots to keep, including the new one. Older ones are deleted.
+        If not set, all are kept.
+    required: false
+    default: null
   force:
     description:
       - the default is C(yes), which will replace the target file when size or modification time is different from the source. 
@@ -62,6 +78,31 @@ options:
     required: false
     choices: [ "yes", "no" ]
     default: "yes"
+  compare:
+    description:
+      - How to decide if an existing target file must be replaced. With C(size_mtime), it is replaced when size or modification time differs.
+      - With C(checksum), when size is the same but modification time differs, the HDFS checksum (MD5-of-MD5-of-CRC32C, or COMPOSITE-CRC)
+        of the source file is computed locally, using target block size and bytes per checksum, and compared to the one provided by HDFS.
+        If identical, only modification time is adjusted.
+      - The crc32c python package should be installed for acceptable performance.
+    required: false
+    choices: [ "size_mtime", "checksum" ]
+    default: "size_mtime"
+  append_detection:
+    description:
+      - For append only files, such as logs or journals. When the local file is longer than the HDFS one, and HDFS content is
+        the beginning of the local file, only the tail is sent, using WebHDFS APPEND.
+      - With C(checksum), the HDFS checksum is compared with the one of the local file prefix. With C(sample), a few ranges of
+        both files are read and compared. With C(no), the file is fully copied again.
+      - Not used when C(backup) is C(yes) with C(backup_mode=rename). Appended data are not checked by C(verify).
+    required: false
+    choices: [ "no", "checksum", "sample" ]
+    default: "no"
+  checksum_processes:
+    description:
+      - Number of processes used to compute local checksums when C(compare=checksum). Default to the number of cores.
+    required: false
+    default: null
   force_ext:
     description:
       - the default is C(yes), which will adjust owner/group/mode on target files and directory with the provided value, if any. 
@@ -104,6 +145,54 @@ options:
         If not defined, will be looked up in local hdfs-site.xml
     required: false
     default: None
+  connect_timeout:
+    description:
+      - Maximum time (in seconds) to establish a connection to the Namenode.
+    required: false
+    default: 10
+  read_timeout:
+    description:
+      - Maximum time (in seconds) to wait for the Namenode to answer (Or between two parts of a long answer, such as a directory listing).
+    required: false
+    default: 60
+  data_connect_timeout:
+    description:
+      - Maximum time (in seconds) to establish a connection to a Datanode, to send or read file content. Default to C(connect_timeout).
+    required: false
+    default: null
+  data_read_timeout:
+    description:
+      - Maximum time (in seconds) to wait for a Datanode while sending file content, or for its answer once sent.
+        Also applies to Datanodes reading file content, when redirected to by the Namenode (checksum, read of a file sample).
+    required: false
+    default: 300
+  deadline:
+    description:
+      - When src is a directory, maximum duration of the run (in seconds). Once reached, no new copy, adjustment or deletion is started,
+        and no more directory is listed on HDFS. Operations in progress are completed, and failed requests are not attempted again.
+      - If the deadline is reached while listing the target tree, nothing is performed. Deletions of C(delete_extraneous) are not performed
+        if some copies were skipped.
+      - If some work was skipped, the module fails, with all the usual results and C(deadline), which reports tasks started, and the tasks and
+        directories skipped. With C(journal), a new run will resume the mirror.
+    required: false
+    default: null
+  max_retries:
+    description:
+      - Number of times a failed WebHDFS request is sent again. Attempts are separated by a random delay, up to C(retry_delay) doubled
+        on each attempt (30 seconds at most).
+      - On a StandbyException or a connection error, requests are switched to the next Namenode of C(webhdfs_endpoint) (or hdfs-site.xml).
+        On a RetriableException or a 5xx response, they are sent again to the same Namenode.
+      - Operations which may have been performed by a failed attempt (RENAME, CONCAT, CREATESNAPSHOT, DELETESNAPSHOT) are only sent again on
+        a StandbyException, a RetriableException or a connection failure. A file transfer (CREATE) is restarted from its first step.
+        Without C(force), only if the failed attempt left no file. Transfers of APPEND are not attempted again.
+      - Retries and failovers are reported in C(retries) in the result.
+    required: false
+    default: 5
+  retry_delay:
+    description:
+      - Maximum delay (in milliseconds) before the first retry of a failed request. See C(max_retries).
+    required: false
+    default: 1000
   hdfs_user:
     description: 
       - Define account to impersonate to perform required operation on HDFS through WebHDFS.
@@ -112,6 +201,218 @@ options:
 
     required: false
     default: "hdfs"
+  http_pool_connections:
+    description:
+      - Number of hosts (Namenode and Datanodes) for which a pool of kept-alive HTTP connections is maintained.
+    required: false
+    default: 10
+  http_pool_maxsize:
+    description:
+      - Maximum number of kept-alive HTTP connections retained in each host pool.
+    required: false
+    default: 10
+  parallelism:
+    description:
+      - When src is a directory, number of files copied simultaneously. Each copy (data transfer, modification time
+        and owner/group/mode setting) is performed by one of a bounded pool of workers. Errors are reported all together once
+        all copies are completed.
+      - http_pool_maxsize is raised to this value if lower.
+    required: false
+    default: 1
+  listing_parallelism:
+    description:
+      - When src is a directory, maximum number of HDFS directory listings (LISTSTATUS) simultaneously in flight
+        while walking the target tree.
+      - http_pool_maxsize is raised to this value if lower.
+    required: false
+    default: 1
+  delete_extraneous:
+    description:
+      - When src is a directory, delete files and directories of the target which do not exist in the source.
+        A missing directory is deleted with all its content by a single recursive DELETE.
+      - Entries excluded by C(include) or C(exclude) are never deleted, nor the directories holding them.
+        Backup files created by C(backup) and parts left by a failed multipart upload are deleted, unless excluded.
+      - Deletion is performed once all files are copied, and not at all if a copy failed. Can't be used with C(pipelined).
+    required: false
+    choices: [ "yes", "no" ]
+    default: "no"
+  max_deletes:
+    description:
+      - Safety cap for C(delete_extraneous). If more files and directories (counting the content of deleted directories)
+        would be deleted, the module fails before performing any change.
+    required: false
+    default: 1000
+  include:
+    description:
+      - When src is a directory, list of patterns. Only files matching at least one of them are copied. Directories are not filtered by
+        C(include), and are always created.
+      - Patterns are matched against the path relative to src. See C(use_regex).
+    required: false
+    default: null
+  exclude:
+    description:
+      - When src is a directory, list of patterns. Matching files and directories are ignored, on both sides. Content of a matching directory
+        is neither scanned locally nor listed on HDFS.
+      - Patterns are matched against the path relative to src. See C(use_regex).
+    required: false
+    default: null
+  use_regex:
+    description:
+      - If C(no), C(include) and C(exclude) are shell style patterns. C(*) and C(?) do not match C(/), C(**) does. A pattern without C(/),
+        such as C(*.tmp) or C(.git), is matched against the last path component. A pattern starting with C(/) or including a C(/), such as
+        C(/staging) or C(logs/*.gz), is matched against the whole relative path.
+      - If C(yes), they are python regular expressions, searched in the relative path.
+    required: false
+    choices: [ "yes", "no" ]
+    default: "no"
+  pipelined:
+    description:
+      - When src is a directory, local and HDFS trees are walked together, directory by directory, and copies start as soon as the first
+        directory is compared, instead of once both trees are fully listed. Directories are listed by C(listing_parallelism) threads.
+      - Can't be used with C(local_manifest) or C(snapshot_diff_cache).
+    required: false
+    choices: [ "yes", "no" ]
+    default: "no"
+  snapshot_diff_cache:
+    description:
+      - When src is a directory, path of a local file where the target tree is recorded, as of a snapshot of the target directory taken by
+        this module. On next run, only the paths reported by the snapshot diff (GETSNAPSHOTDIFF) since this snapshot are listed again,
+        instead of the whole target tree. A new snapshot then replaces the previous one.
+      - The target directory (C(hdfs_dest), with the basename of C(src) if not ending with '/') must be snapshottable
+        (C(hdfs dfsadmin -allowSnapshot)). Otherwise, or if the previous snapshot or the cache is missing, the whole tree is listed.
+      - Snapshots are named C(hdfs_put-<timestamp>). Any other such snapshot of the target directory is deleted, so only the new one is kept.
+        Not used in check mode.
+    required: false
+    default: null
+  local_scan_parallelism:
+    description:
+      - When src is a directory, number of local directories scanned simultaneously. Useful when src is on a network
+        file system (NFS), where each file status is a round trip to the server.
+      - The C(scandir) package is used when installed, so each entry is stat'ed once, and entries rejected by C(include)/C(exclude)
+        are not stat'ed at all. Otherwise, directories are listed with C(os.listdir), then C(os.lstat) is called on each entry (and C(os.stat) on symlinks).
+    required: false
+    default: 1
+  journal:
+    description:
+      - When src is a directory, path of a local file where directories are recorded as soon as all their files are copied. It is removed
+        at the end of a successful run. If a run fails or is interrupted, the next one does not list again on HDFS the recorded directories
+        whose local files (name, size and modification time) and sub-directories did not change. Their content is assumed to be mirrored.
+      - The journal is ignored if written for another src, hdfs_dest, owner, group, mode, directory_mode, force, force_ext or filters.
+        HDFS changes performed by others between both runs are not detected in recorded directories. Not used in check mode.
+      - Can't be used with C(pipelined), C(snapshot_diff_cache) or C(delete_extraneous).
+    required: false
+    default: null
+  local_manifest:
+    description:
+      - When src is a directory, path of a file where the local tree is recorded at the end of each successful run (not in check mode).
+        On next run, directories whose modification time did not change are not listed again. Only directories are stat'ed.
+        Local checksums computed by C(compare=checksum) and C(append_detection=checksum) are also recorded, and reused while the file is unchanged.
+      - The modification time of a directory changes when an entry is added, removed or renamed, but not when a file is modified in place.
+        So use this only for sources where files are written once, or replaced by renaming a new file over it.
+      - The manifest is ignored if it was written for another src.
+    required: false
+    default: null
+  adaptive_concurrency:
+    description:
+      - Adapt the number of WebHDFS requests simultaneously in flight on the Namenode (listings, metadata operations, first step of copies) to its load,
+        between C(min_concurrency) and C(max_concurrency). Data transfers to Datanodes are not limited.
+      - Starting from C(min_concurrency), the limit grows by one on each successful request until the first congestion signal, then by one per round
+        of requests. It is halved on each congestion signal (a 5xx response, a RetriableException, a timeout, or a request slower than C(target_latency)).
+        Other failures (i.e. connection refused) leave it unchanged.
+      - Changes of the limit are reported in C(concurrency) in the result. Actual concurrency is still bounded by C(parallelism),
+        C(listing_parallelism) and C(metadata_window).
+    required: false
+    choices: [ "yes", "no" ]
+    default: "no"
+  max_bandwidth:
+    description:
+      - Maximum data rate (in bytes per second) sent to Datanodes, all copies and parts together, whatever C(parallelism) and C(multipart_parallelism).
+      - Time spent waiting for it is reported in C(throttling) in the result.
+    required: false
+    default: null
+  max_ops_per_sec:
+    description:
+      - Maximum number of WebHDFS requests per second sent to the Namenode, by all workers together.
+    required: false
+    default: null
+  min_concurrency:
+    description:
+      - Lower bound of the Namenode requests in flight with C(adaptive_concurrency).
+    required: false
+    default: 1
+  max_concurrency:
+    description:
+      - Upper bound of the Namenode requests in flight with C(adaptive_concurrency). Default to the effective http_pool_maxsize.
+    required: false
+    default: null
+  target_latency:
+    description:
+      - With C(adaptive_concurrency), Namenode request duration (in milliseconds) above which the Namenode is considered as overloaded.
+    required: false
+    default: 1000
+  metadata_window:
+    description:
+      - When src is a directory, maximum number of owner/group/mode adjustments (SETOWNER, SETPERMISSION)
+        simultaneously in flight on existing files and directories. Errors are reported all together, by path.
+      - http_pool_maxsize is raised to this value if lower.
+    required: false
+    default: 1
+  multipart_threshold:
+    description:
+      - Files of at least this size (in bytes) are split in parts of C(multipart_part_size) bytes, uploaded in parallel
+        to temporary files in the target directory, then joined with WebHDFS CONCAT. If not set, each file is sent as a single stream.
+      - Complete parts left by a failed run are not sent again when the task is re-run. Parts left by a previous version
+        of the file (different size or modification time) must be cleaned up manually.
+    required: false
+    default: null
+  multipart_part_size:
+    description:
+      - Size of each part of a multipart upload. Should be a multiple of the HDFS block size, as each part ends with its own last block.
+        This is required by C(verify).
+    required: false
+    default: 268435456
+  multipart_parallelism:
+    description:
+      - Number of parts of a single file uploaded simultaneously. Combined with C(parallelism), which bounds the number of files.
+      - http_pool_maxsize is raised to C(parallelism) x C(multipart_parallelism) if lower.
+    required: false
+    default: 4
+  hdfs_umask:
+    description:
+      - The umask of the target cluster (C(fs.permissions.umask-mode)). When C(mode) is not altered by this umask,
+        it is provided on file creation, thus saving a SETPERMISSION call.
+    required: false
+    default: "022"
+  verify:
+    description:
+      - If C(yes), HDFS checksum of each uploaded file is computed on the fly while sending data, and then compared with the one
+        provided by HDFS (GETFILECHECKSUM). On mismatch, upload is retried once, then the module fails.
+        Local file is never read twice for verification, except for files uploaded in parts (see C(multipart_threshold)),
+        which are read again once all parts are concatenated.
+      - Memory usage is 4 bytes per chunk of C(hdfs_bytes_per_checksum) bytes of the file being uploaded (less than 1%).
+    required: false
+    choices: [ "yes", "no" ]
+    default: "no"
+  zero_copy:
+    description:
+      - If C(yes), file content is sent to Datanodes by the kernel (sendfile), without being copied in python buffers.
+        Requires the C(pysendfile) package (C(sendfile) module), or an C(os.sendfile) provided by the python interpreter.
+        Otherwise, or if not supported by the system, data are copied as usual.
+      - Not used for files sent with C(verify), as their content must be read to compute their checksum.
+    required: false
+    choices: [ "yes", "no" ]
+    default: "yes"
+  hdfs_checksum_type:
+    description:
+      - The checksum type of the target cluster (C(dfs.checksum.type)). Used by C(verify).
+    required: false
+    choices: [ "CRC32C", "CRC32" ]
+    default: "CRC32C"
+  hdfs_bytes_per_checksum:
+    description:
+      - The number of bytes per checksum of the target cluster (C(dfs.bytes-per-checksum)). Used by C(verify).
+    required: false
+    default: 512
       
 author:
     - "Serge ALEXANDRE"
@@ -133,7 +434,29 @@ EXAMPLES = '''
 
 '''
 
+import os
+import stat
 from xml.dom import minidom
+import threading
+import Queue
+import urllib
+import re
+import mmap
+import struct
+import hashlib
+import zlib
+import multiprocessing
+import array
+import httplib
+import urlparse
+import errno
+import socket
+import select
+import json
+import sys
+import bisect
+import resource
+import random
 
 HAS_REQUESTS = False
 
@@ -151,16 +474,203 @@ try:
 except ImportError:
     pass
 
+HAS_IJSON = False
+try:
+    import ijson
+    HAS_IJSON = True
+except ImportError:
+    pass
+
+HAS_CRC32C = False
+try:
+    import crc32c
+    HAS_CRC32C = True
+except ImportError:
+    pass
+
+# scandir package. os.scandir, if the interpreter provides it
+HAS_SCANDIR = False
+try:
+    from os import scandir
+    HAS_SCANDIR = True
+except ImportError:
+    try:
+        from scandir import scandir
+        HAS_SCANDIR = True
+    except ImportError:
+        pass
+
+# pysendfile provides sendfile() to python 2. Some interpreters provide os.sendfile
+HAS_SENDFILE = False
+try:
+    from sendfile import sendfile
+    HAS_SENDFILE = True
+except ImportError:
+    sendfile = getattr(os, "sendfile", None)
+    HAS_SENDFILE = sendfile != None
+
 
 # Global, to allow access from error
 module = None
 
+# Only the last changes of the concurrency limit are reported
+ADAPTIVE_MAX_DECISIONS = 100
+
+# Namenode operations which can't be sent again if the first attempt may have been performed
+NON_IDEMPOTENT_OPS = ( "RENAME", "CONCAT", "CREATESNAPSHOT", "DELETESNAPSHOT", "RENAMESNAPSHOT", "CANCELDELEGATIONTOKEN" )
+# Upper bound of the delay between two attempts (seconds)
+RETRY_MAX_DELAY = 30.0
+
+class AdaptiveConcurrency:
+    """ AIMD control of the number of Namenode requests in flight, between minimum and maximum.
+        A request answered with a 5xx code or a RetriableException, timed out, or slower than targetLatency (seconds), is a congestion signal: The limit is halved.
+        A request failed otherwise (i.e. connection refused) does not change the limit.
+        It is not halved again for requests issued before this decrease. Otherwise, each successful request raises the limit:
+        By one until the first congestion (slow start), then by 1/limit (one per round of requests) """
+    def __init__(self, minimum, maximum, targetLatency):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.targetLatency = targetLatency
+        self.limit = float(minimum)
+        self.inFlight = 0
+        self.slowStart = True
+        self.lastDecrease = 0
+        self.condition = threading.Condition()
+        self.start = time.time()
+        self.stats = { 'initial': minimum, 'minimum': minimum, 'maximum': maximum, 'lowest': minimum, 'highest': minimum, 'increases': 0, 'decreases': 0,
+                       'congestions': { 'server_error': 0, 'retriable': 0, 'latency': 0, 'timeout': 0 }, 'failures': 0, 'decisions': [] }
+
+    def acquire(self):
+        """ Wait for a free slot. Return the issue time of the request """
+        with self.condition:
+            while self.inFlight >= int(self.limit):
+                self.condition.wait()
+            self.inFlight += 1
+            return time.time()
+
+    def release(self, issued, congestion, failed = False):
+        """ congestion: None, or the kind of congestion signal (A key of stats['congestions']).
+            failed: Request failed without congestion signal """
+        with self.condition:
+            self.inFlight -= 1
+            previous = int(self.limit)
+            if failed and congestion == None:
+                self.stats['failures'] += 1
+            elif congestion != None:
+                self.stats['congestions'][congestion] += 1
+                if issued >= self.lastDecrease:
+                    self.slowStart = False
+                    self.lastDecrease = time.time()
+                    self.limit = max(float(self.minimum), self.limit / 2)
+            elif self.slowStart:
+                self.limit = min(float(self.maximum), self.limit + 1)
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+            if int(self.limit) != previous:
+                self.decide(previous, congestion)
+            self.condition.notify_all()
+
+    def decide(self, previous, congestion):
+        limit = int(self.limit)
+        if limit > previous:
+            self.stats['increases'] += 1
+            self.stats['highest'] = max(self.stats['highest'], limit)
+        else:
+            self.stats['decreases'] += 1
+            self.stats['lowest'] = min(self.stats['lowest'], limit)
+        decisions = self.stats['decisions']
+        decisions.append({ 'at': round(time.time() - self.start, 3), 'limit': limit, 'reason': congestion if congestion != None else "success" })
+        if len(decisions) > ADAPTIVE_MAX_DECISIONS:
+            del decisions[0]
+
+    def getStats(self):
+        with self.condition:
+            return dict(self.stats, final=int(self.limit))
+
+
+class TokenBucket:
+    """ Limit a rate (units per second) shared by several threads. Up to one second of unused rate can be spent in a burst.
+        Consumers take what they need, possibly borrowing on the future, and wait until the debt is paid back """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        # Full: Nothing was spent yet
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+        self.waited = 0.0
+
+    def consume(self, count):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate) - count
+            self.last = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def getStats(self):
+        return { 'rate': int(self.rate), 'waited_seconds': round(self.waited, 3) }
+
+
+class ThrottledReader:
+    """ Wrap an upload source (FileSlice, ChecksumReader), to read it no faster than a TokenBucket allows """
+    def __init__(self, source, bucket):
+        self.source = source
+        self.bucket = bucket
+        self.len = source.len     # Allow requests to set Content-Length
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.bucket.consume(len(data))
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(64 * 1024)
+            if not data:
+                return
+            yield data
+
+
 class WebHDFS:
  
-    def __init__(self, endpoint, hdfsUser):
+    def __init__(self, endpoint, hdfsUser, poolConnections, poolMaxsize, metadataTimeout, dataTimeout):
         self.endpoint = endpoint
+        # Shared keep-alive connection pools. One pool per host (Namenode and each Datanode)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=poolConnections, pool_maxsize=poolMaxsize)
+        self.session.mount("http://", adapter)
+        # (connect, read) timeouts in seconds, of Namenode requests, and of requests moving file content
+        self.metadataTimeout = metadataTimeout
+        self.dataTimeout = dataTimeout
+        # A Deadline. Once reached, failed requests are not attempted again
+        self.deadline = None
         self.delegationToken = None
         self.auth = None
+        # Will be reset on first LISTSTATUS_BATCH failure (Hadoop < 2.8)
+        self.listStatusBatch = True
+        # Will be reset if the Namenode answer with a redirect despite noredirect=true (Hadoop < 2.8)
+        self.noRedirect = True
+        # Send data to Datanodes with sendfile(), bypassing python buffers. Reset if not supported
+        self.zeroCopy = False
+        # Kept-alive connections to Datanodes used by sendfile, by host:port
+        self.datanodeLock = threading.Lock()
+        self.datanodeConnections = {}
+        self.datanodeStats = { 'requests': 0, 'connections': 0 }
+        self.transfersLock = threading.Lock()
+        self.transfers = {}
+        # An AdaptiveConcurrency bounding Namenode requests in flight. None: Bounded only by callers
+        self.concurrency = None
+        # TokenBuckets shared by all threads, limiting data sent to Datanodes (bytes) and Namenode requests. None: No limit
+        self.bandwidth = None
+        self.namenodeRate = None
+        # HA Namenodes. Requests are switched to the next one on StandbyException or connection error
+        self.candidates = [ endpoint ]
+        self.maxRetries = 0
+        self.retryDelay = 1.0
+        self.retryLock = threading.Lock()
+        self.retryStats = { 'connection': 0, 'standby': 0, 'retriable': 0, 'server_error': 0, 'datanode': 0, 'failovers': 0 }
         if hdfsUser == "KERBEROS":
             self.kerberos = True
             if not HAS_KERBEROS:
@@ -175,7 +685,7 @@ class WebHDFS:
             if self.kerberos:
                 kerberos_auth = HTTPKerberosAuth()
                 url = "http://{0}/webhdfs/v1/?op=GETDELEGATIONTOKEN".format(self.endpoint)
-                resp = requests.get(url, auth=kerberos_auth)
+                resp = self.session.get(url, auth=kerberos_auth, timeout=self.metadataTimeout)
                 if resp.status_code == 200:
                     result = resp.json()
                     self.delegationToken = result['Token']['urlString']
@@ -187,7 +697,7 @@ class WebHDFS:
                     return (False, "{0}  =>  Response code: {1}".format(url, resp.status_code))
             else:
                 url = "http://{0}/webhdfs/v1/?{1}op=GETFILESTATUS".format(self.endpoint, self.auth)
-                resp = requests.get(url)
+                resp = self.session.get(url, timeout=self.metadataTimeout)
                 if resp.status_code == 200:
                     return (True, "")
                 elif resp.status_code == 401:
@@ -205,11 +715,127 @@ class WebHDFS:
         if self.kerberos and self.delegationToken != None:
             url = "http://{0}/webhdfs/v1/?{1}op=CANCELDELEGATIONTOKEN&token={2}".format(self.endpoint, self.auth, self.delegationToken)
             self.put(url)
+        self.session.close()
+        for connections in self.datanodeConnections.values():
+            for conn in connections:
+                conn.close()
+
+    def getConnectionStats(self):
+        # urllib3 maintains per host counters. Each request which did not open a new connection reused a kept-alive one.
+        stats = { 'requests': 0, 'connections': 0 }
+        for adapter in self.session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats['requests'] += pool.num_requests
+                stats['connections'] += pool.num_connections
+        stats['requests'] += self.datanodeStats['requests']
+        stats['connections'] += self.datanodeStats['connections']
+        stats['reused_connections'] = stats['requests'] - stats['connections']
+        return stats
+
+    def namenodeRequest(self, method, url, **kwargs):
+        """ All requests to the Namenode (including the ones redirected to a Datanode, but not data transfers) go through here.
+            Failed attempts are sent again, up to maxRetries times, if this is safe for the operation. Return the last response """
+        op = urlparse.parse_qs(urlparse.urlparse(url).query).get('op', [ "" ])[0]
+        idempotent = op not in NON_IDEMPOTENT_OPS
+        kwargs.setdefault('timeout', self.metadataTimeout)
+        target = url.split("/", 3)[3]
+        attempt = 0
+        while True:
+            endpoint = self.endpoint
+            try:
+                resp = self.sendToNamenode(method, "http://{0}/{1}".format(endpoint, target), **kwargs)
+            except requests.exceptions.RequestException as e:
+                # Namenode down, or unreachable. Only a request never sent can be sent again if not idempotent
+                if not self.canRetry(attempt) or not (idempotent or isNotSent(e)):
+                    raise
+                reason = 'connection'
+            else:
+                exception = getRemoteException(resp) if resp.status_code >= 400 else None
+                if exception == "StandbyException":
+                    reason = 'standby'
+                elif exception == "RetriableException":
+                    reason = 'retriable'
+                elif resp.status_code >= 500 and idempotent:
+                    reason = 'server_error'
+                else:
+                    return resp
+                if not self.canRetry(attempt):
+                    return resp
+                # Release its pooled connection, as streamed responses are not read
+                resp.close()
+            if reason in ('connection', 'standby'):
+                self.failover(endpoint)
+            self.backoff(reason, attempt)
+            attempt += 1
+
+    def canRetry(self, attempt):
+        return attempt < self.maxRetries and (self.deadline == None or not self.deadline.reached())
+
+    def failover(self, endpoint):
+        """ Switch to the next candidate, unless another thread already did it """
+        with self.retryLock:
+            if self.endpoint == endpoint and len(self.candidates) > 1:
+                self.endpoint = self.candidates[(self.candidates.index(endpoint) + 1) % len(self.candidates)]
+                self.retryStats['failovers'] += 1
+
+    def backoff(self, reason, attempt):
+        """ Exponential, with full jitter to spread workers failing together """
+        with self.retryLock:
+            self.retryStats[reason] += 1
+        time.sleep(random.uniform(0, min(RETRY_MAX_DELAY, self.retryDelay * (2 ** attempt))))
+
+    def getRetryStats(self):
+        return dict(self.retryStats, endpoint=self.endpoint)
+
+    def sendToNamenode(self, method, url, **kwargs):
+        if self.namenodeRate != None:
+            self.namenodeRate.consume(1)
+        if self.concurrency == None:
+            return self.session.request(method, url, **kwargs)
+        issued = self.concurrency.acquire()
+        congestion = None
+        failed = True
+        try:
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except requests.exceptions.Timeout:
+                # A Namenode too busy to accept the connection, or to answer
+                congestion = 'timeout'
+                raise
+            failed = False
+            if resp.status_code >= 500:
+                congestion = 'server_error'
+            elif resp.status_code >= 400 and "RetriableException" in resp.content:
+                congestion = 'retriable'
+            elif time.time() - issued > self.concurrency.targetLatency:
+                congestion = 'latency'
+            return resp
+        finally:
+            self.concurrency.release(issued, congestion, failed)
+
+    def getThrottlingStats(self):
+        if self.bandwidth == None and self.namenodeRate == None:
+            return None
+        return { 'bandwidth': self.bandwidth.getStats() if self.bandwidth != None else None,
+                 'namenode_ops': self.namenodeRate.getStats() if self.namenodeRate != None else None }
+
+    def getTransferStats(self):
+        """ Throughput of each data transfer to a Datanode, by HDFS path """
+        totalBytes = sum(t[0] for t in self.transfers.values())
+        totalSeconds = sum(t[1] for t in self.transfers.values())
+        return {
+            'engine': "sendfile" if self.zeroCopy else "requests",
+            'bytes': totalBytes,
+            'seconds': round(totalSeconds, 3),
+            'files': dict((path, int(t[0] / t[1]) if t[1] > 0 else None) for (path, t) in self.transfers.iteritems())
+        }
       
 
     def getPathTypeAndStatus(self, path):
         url = "http://{0}/webhdfs/v1{1}?{2}op=GETFILESTATUS".format(self.endpoint, path, self.auth)
-        resp = requests.get(url)
+        resp = self.namenodeRequest("GET", url)
         if resp.status_code == 200:
             result = resp.json()
             fs = {}
@@ -218,6 +844,7 @@ class WebHDFS:
             fs['mode'] = "0" + result['FileStatus']['permission']
             fs['owner'] = result['FileStatus']['owner']
             fs['group'] = result['FileStatus']['group']
+            fs['blockSize'] = result['FileStatus']['blockSize']
             return (result['FileStatus']['type'], fs)
         elif resp.status_code == 404:
             return ("NOT_FOUND", None)
@@ -228,7 +855,7 @@ class WebHDFS:
      
             
     def put(self, url):
-        resp = requests.put(url, allow_redirects=False)
+        resp = self.namenodeRequest("PUT", url, allow_redirects=False)
         if resp.status_code != 200:  
             error("Invalid returned http code '{0}' when calling '{1}'", resp.status_code, url)
 
@@ -239,12 +866,12 @@ class WebHDFS:
             url = "http://{0}/webhdfs/v1{1}?{2}op=MKDIRS".format(self.endpoint, path, self.auth)
         self.put(url)
 
-    def setOwner(self, path, owner):
-        url = "http://{0}/webhdfs/v1{1}?{2}op=SETOWNER&owner={3}".format(self.endpoint, path, self.auth, owner)
-        self.put(url)
-
-    def setGroup(self, path, group):
-        url = "http://{0}/webhdfs/v1{1}?{2}op=SETOWNER&group={3}".format(self.endpoint, path, self.auth, group)
+    def setOwner(self, path, owner, group):
+        url = "http://{0}/webhdfs/v1{1}?{2}op=SETOWNER".format(self.endpoint, path, self.auth)
+        if owner != None:
+            url = url + "&owner=" + owner
+        if group != None:
+            url = url + "&group=" + group
         self.put(url)
     
     def setPermission(self, path, permission):
@@ -255,51 +882,260 @@ class WebHDFS:
         url = "http://{0}/webhdfs/v1{1}?{2}op=SETTIMES&modificationtime={3}".format(self.endpoint, hdfsPath, self.auth, long(modTime)*1000)
         self.put(url)
 
-    def putFileToHdfs(self, localPath, hdfsPath, overwrite):
+    def putFileToHdfs(self, localPath, hdfsPath, overwrite, permission, verify):
+        """ verify: None, or (crcType, bytesPerCrc). In such case, return a ChecksumReader holding checksum of sent data """
         url = "http://{0}/webhdfs/v1{1}?{2}op=CREATE&overwrite={3}".format(self.endpoint, hdfsPath, self.auth, "true" if overwrite else "false")
-        resp = requests.put(url, allow_redirects=False)
-        if not resp.status_code == 307:
-            error("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
-        url2 = resp.headers['location']    
+        if permission != None:
+            url = url + "&permission=" + permission
+        return self.createFile(url, hdfsPath, localPath, 0, os.path.getsize(localPath), overwrite, verify)
+
+    def createFile(self, url, hdfsPath, localPath, offset, length, overwrite, verify):
+        """ Both steps of CREATE. A failed transfer to the Datanode is attempted again from the first step, up to maxRetries times.
+            Without overwrite, only if the failed attempt did not leave a file. Return as sendToDatanode() """
+        attempt = 0
+        while True:
+            url2 = self.getDatanodeLocation("PUT", url)
+            try:
+                return self.sendToDatanode("PUT", url2, hdfsPath, localPath, offset, length, 201, verify)
+            except (TransferError, requests.exceptions.RequestException, httplib.HTTPException, socket.error) as e:
+                if not self.canRetry(attempt):
+                    error("{0}", e)
+                if not overwrite:
+                    (ft, _) = self.getPathTypeAndStatus(hdfsPath)
+                    if ft != "NOT_FOUND":
+                        error("{0} (Not retried, as '{1}' exists and overwrite is not allowed)", e, hdfsPath)
+            self.backoff('datanode', attempt)
+            attempt += 1
+
+    def getDatanodeLocation(self, method, url):
+        """ First step of CREATE and APPEND. With noredirect, the Namenode provides the Datanode url in its JSON response
+            instead of a redirect, which would be followed by some proxies """
+        if self.noRedirect:
+            url = url + "&noredirect=true"
+        resp = self.namenodeRequest(method, url, allow_redirects=False)
+        if resp.status_code == 307:
+            # noredirect is not supported (Hadoop < 2.8)
+            self.noRedirect = False
+            return resp.headers['location']
+        if resp.status_code == 200 and self.noRedirect:
+            return resp.json()['Location']
+        error("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
+
+    def readFromDatanode(self, url):
+        """ OPEN and GETFILECHECKSUM, which the Namenode redirects to a Datanode. The redirect is followed here, so a failing Datanode is not
+            taken for a failing Namenode (no failover). A failed Datanode request is attempted again from the first step, which may select another Datanode """
+        attempt = 0
+        while True:
+            resp = self.namenodeRequest("GET", url, allow_redirects=False)
+            if resp.status_code not in (301, 302, 303, 307):
+                # An error, or answered directly (i.e. by an HttpFS gateway)
+                return resp
+            try:
+                return self.session.get(resp.headers['location'], timeout=self.dataTimeout)
+            except requests.exceptions.RequestException:
+                if not self.canRetry(attempt):
+                    raise
+            self.backoff('datanode', attempt)
+            attempt += 1
+
+    def sendToDatanode(self, method, url, hdfsPath, localPath, offset, length, expectedCode, verify):
+        """ Second step of CREATE and APPEND: Send 'length' bytes of localPath, starting at 'offset', to the Datanode url.
+            verify: None, or (crcType, bytesPerCrc) for a whole file. In such case, return a ChecksumReader holding checksum of sent data """
+        start = time.time()
         f = open(localPath, "rb")
-        resp2 = requests.put(url2, data=f, headers={'content-type': 'application/octet-stream'})
-        if not resp2.status_code == 201:
-           error("Invalid returned http code '{0}' when calling '{1}'".format(resp2.status_code, url2))
+        try:
+            if verify == None and self.zeroCopy and url.startswith("http:"):
+                statusCode = self.sendfileRequest(method, url, f, offset, length)
+                data = None
+            else:
+                if verify != None:
+                    data = ChecksumReader(f, length, verify[0], verify[1])
+                else:
+                    data = FileSlice(f, offset, length)
+                body = ThrottledReader(data, self.bandwidth) if self.bandwidth != None else data
+                statusCode = self.session.request(method, url, data=body, headers={'content-type': 'application/octet-stream'}, timeout=self.dataTimeout).status_code
+        finally:
+            f.close()
+        if statusCode != expectedCode:
+           raise TransferError("Invalid returned http code '{0}' when calling '{1}'".format(statusCode, url))
+        with self.transfersLock:
+            self.transfers[hdfsPath] = (length, time.time() - start)
+        if verify != None:
+            data.finish()
+            return data
+        return None
+
+    def sendfileRequest(self, method, url, f, offset, length):
+        """ Issue the HTTP request by hand, as body is sent by the kernel from file to socket. Return HTTP status code """
+        u = urlparse.urlparse(url)
+        for attempt in range(2):
+            (conn, reused) = self.acquireDatanodeConnection(u)
+            try:
+                conn.putrequest(method, u.path + ("?" + u.query if u.query else ""), skip_accept_encoding=True)
+                conn.putheader('Content-Type', 'application/octet-stream')
+                conn.putheader('Content-Length', str(length))
+                conn.endheaders()
+                # Connection is established. Its timeout was the connect one
+                conn.sock.settimeout(self.dataTimeout[1])
+                self.sendfileBody(conn, f, offset, length)
+                resp = conn.getresponse()
+                resp.read()
+            except (httplib.HTTPException, socket.error, OSError):
+                conn.close()
+                # A kept-alive connection may have been closed by the Datanode meanwhile. Only CREATE can be safely sent again
+                if reused and method == "PUT" and attempt == 0:
+                    continue
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self.releaseDatanodeConnection(u, conn)
+            return resp.status
+
+    def sendfileBody(self, conn, f, offset, length):
+        sent = 0
+        # When throttled, send by slices of 1/10 of a second
+        chunk = max(64 * 1024, int(self.bandwidth.rate / 10)) if self.bandwidth != None else length
+        while sent < length:
+            try:
+                n = sendfile(conn.sock.fileno(), f.fileno(), offset + sent, min(length - sent, chunk))
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    # Socket has a timeout, so is non-blocking for the system. Wait for it to be writable
+                    if not select.select([], [ conn.sock ], [], conn.sock.gettimeout())[1]:
+                        raise socket.timeout("Timeout while sending '{0}'".format(f.name))
+                    continue
+                if sent > 0 or e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                # Not supported for this file or socket. Fall back on copying data
+                self.zeroCopy = False
+                source = FileSlice(f, offset, length)
+                for data in ThrottledReader(source, self.bandwidth) if self.bandwidth != None else source:
+                    conn.sock.sendall(data)
+                return
+            if n == 0:
+                error("'{0}' was truncated while being sent", f.name)
+            if self.bandwidth != None:
+                self.bandwidth.consume(n)
+            sent += n
+
+    def acquireDatanodeConnection(self, u):
+        """ Return (connection, reused) """
+        with self.datanodeLock:
+            self.datanodeStats['requests'] += 1
+            connections = self.datanodeConnections.get(u.netloc)
+            if connections:
+                return (connections.pop(), True)
+            self.datanodeStats['connections'] += 1
+        return (httplib.HTTPConnection(u.hostname, u.port if u.port != None else 80, timeout=self.dataTimeout[0]), False)
+
+    def releaseDatanodeConnection(self, u, conn):
+        with self.datanodeLock:
+            self.datanodeConnections.setdefault(u.netloc, []).append(conn)
            
-    def rename(self, hdfsPath, newName):
+    def getFileChecksum(self, path):
+        url = "http://{0}/webhdfs/v1{1}?{2}op=GETFILECHECKSUM".format(self.endpoint, path, self.auth)
+        resp = self.readFromDatanode(url)
+        if resp.status_code == 200:
+            return resp.json()['FileChecksum']
+        elif resp.status_code == 404:
+            return None
+        else:
+            error("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
+
+    def appendToHdfs(self, localPath, hdfsPath, offset, length):
+        """ Append 'length' bytes of localPath, starting at 'offset', to hdfsPath """
+        url = "http://{0}/webhdfs/v1{1}?{2}op=APPEND".format(self.endpoint, hdfsPath, self.auth)
+        url2 = self.getDatanodeLocation("POST", url)
+        # Not attempted again: Part of the data may have been appended
+        try:
+            self.sendToDatanode("POST", url2, hdfsPath, localPath, offset, length, 200, None)
+        except TransferError as e:
+            error("{0}", e)
+
+    def readRange(self, path, offset, length):
+        url = "http://{0}/webhdfs/v1{1}?{2}op=OPEN&offset={3}&length={4}".format(self.endpoint, path, self.auth, offset, length)
+        resp = self.readFromDatanode(url)
+        if resp.status_code != 200:
+            error("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
+        return resp.content
+
+    def putPartToHdfs(self, localPath, hdfsPath, offset, length, permission):
+        """ Upload 'length' bytes of localPath, starting at 'offset', as a new HDFS file. Overwrite any previous attempt """
+        url = "http://{0}/webhdfs/v1{1}?{2}op=CREATE&overwrite=true".format(self.endpoint, hdfsPath, self.auth)
+        if permission != None:
+            url = url + "&permission=" + permission
+        self.createFile(url, hdfsPath, localPath, offset, length, True, None)
+
+    def concat(self, hdfsPath, sources):
+        url = "http://{0}/webhdfs/v1{1}?{2}op=CONCAT&sources={3}".format(self.endpoint, hdfsPath, self.auth, ",".join(sources))
+        resp = self.namenodeRequest("POST", url)
+        if resp.status_code != 200:  
+            error("Invalid returned http code '{0}' when calling '{1}'", resp.status_code, url)
+
+    def rename(self, hdfsPath, newName, overwrite=False):
+        """ Return False if the Namenode did not rename (i.e. newName exists) """
         url = "http://{0}/webhdfs/v1{1}?{2}op=RENAME&destination={3}".format(self.endpoint, hdfsPath, self.auth, newName)
-        self.put(url)
+        if overwrite:
+            url = url + "&renameoptions=OVERWRITE"
+        resp = self.namenodeRequest("PUT", url, allow_redirects=False)
+        if resp.status_code != 200:  
+            error("Invalid returned http code '{0}' when calling '{1}'", resp.status_code, url)
+        if not resp.content:
+            # With renameoptions, nothing is returned. A failure is reported as an exception
+            return True
+        return resp.json()['boolean']
            
                             
+    def delete(self, path):
+        url = "http://{0}/webhdfs/v1{1}?{2}op=DELETE&recursive=true".format(self.endpoint, path, self.auth)
+        resp = self.namenodeRequest("DELETE", url)
+        if resp.status_code != 200:
+            error("Invalid returned http code '{0}' when calling '{1}'", resp.status_code, url)
+
+    def createSnapshot(self, path, name):
+        """ Return False if path is not snapshottable """
+        url = "http://{0}/webhdfs/v1{1}?{2}op=CREATESNAPSHOT&snapshotname={3}".format(self.endpoint, path, self.auth, name)
+        resp = self.namenodeRequest("PUT", url)
+        if resp.status_code == 200:
+            return True
+        elif resp.status_code == 403:
+            return False
+        else:
+            error("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
+
+    def deleteSnapshot(self, path, name):
+        url = "http://{0}/webhdfs/v1{1}?{2}op=DELETESNAPSHOT&snapshotname={3}".format(self.endpoint, path, self.auth, name)
+        resp = self.namenodeRequest("DELETE", url)
+        if resp.status_code != 200:
+            error("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
+
+    def listSnapshots(self, path):
+        """ Return snapshot names. Empty if path is not snapshottable """
+        dirContent = self.getDirContent(os.path.join(path, ".snapshot"))
+        if dirContent['status'] != "OK":
+            return []
+        return [ e['name'] for e in dirContent['entries'] ]
+
+    def getSnapshotDiff(self, path, oldName, newName):
+        """ Return the list of differences, or None if a snapshot does not exist """
+        url = "http://{0}/webhdfs/v1{1}?{2}op=GETSNAPSHOTDIFF&oldsnapshotname={3}&snapshotname={4}".format(self.endpoint, path, self.auth, oldName, newName)
+        resp = self.namenodeRequest("GET", url)
+        if resp.status_code == 200:
+            return resp.json()['SnapshotDiffReport']['diffList']
+        elif resp.status_code == 403 or resp.status_code == 404:
+            return None
+        else:
+            error("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
+
     def getDirContent(self, path):
-        url = "http://{0}/webhdfs/v1{1}?{2}op=LISTSTATUS".format(self.endpoint, path, self.auth)
-        resp = requests.get(url)
+        """ Return a dirContent with a 'status' and, if OK, an 'entries' generator. Entries are fetched and decoded page by page """
         dirContent = {}
         dirContent['status'] = "OK"
-        dirContent['files'] = []
-        dirContent['directories'] = []
+        dirContent['entries'] = iter([])
+        (batch, url, resp) = self.requestDirPage(path, None)
         if resp.status_code == 200:
-            result = resp.json()
-            for f in result['FileStatuses']['FileStatus']:
-                if f['type'] == 'FILE':
-                    fi = {}
-                    fi['name'] = f['pathSuffix']
-                    fi['size'] = f['length']
-                    fi['modificationTime'] = f['modificationTime']/1000
-                    fi['mode'] = "0" + f['permission']
-                    fi['owner'] = f['owner']
-                    fi['group'] = f['group']
-                    dirContent['files'].append(fi)
-                elif f['type'] == 'DIRECTORY':
-                    di = {}
-                    di['name'] = f['pathSuffix']
-                    #di['modificationTime'] = f['modificationTime']/1000
-                    di['mode'] = "0" + f['permission']
-                    di['owner'] = f['owner']
-                    di['group'] = f['group']
-                    dirContent['directories'].append(di)
-                else:
-                    error("Unknown directory entry type: {0}".format(f['type']))
+            dirContent['entries'] = self.iterDirEntries(path, batch, url, resp)
         elif resp.status_code == 404:
             dirContent['status'] = "NOT_FOUND"
         elif resp.status_code == 403:
@@ -307,6 +1143,116 @@ class WebHDFS:
         else:
             error("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
         return dirContent
+
+    def requestDirPage(self, path, startAfter):
+        if self.listStatusBatch:
+            url = "http://{0}/webhdfs/v1{1}?{2}op=LISTSTATUS_BATCH".format(self.endpoint, path, self.auth)
+            if startAfter != None:
+                url = url + "&startAfter=" + urllib.quote(startAfter.encode('utf-8'), safe='')
+            resp = self.namenodeRequest("GET", url, stream=True)
+            if resp.status_code != 400 or startAfter != None:
+                return (True, url, resp)
+            # Unknown operation for this namenode. Fall back to plain LISTSTATUS from now on.
+            resp.close()
+            self.listStatusBatch = False
+        url = "http://{0}/webhdfs/v1{1}?{2}op=LISTSTATUS".format(self.endpoint, path, self.auth)
+        return (False, url, self.namenodeRequest("GET", url, stream=True))
+
+    def iterDirEntries(self, path, batch, url, resp):
+        """ A page which can't be fully read (connection reset, read timeout) is requested again, from the last yielded entry.
+            A plain LISTSTATUS can't be resumed, so entries already yielded are skipped """
+        startAfter = None
+        yielded = 0
+        attempt = 0
+        while True:
+            if batch:
+                itemPrefix = "DirectoryListing.partialListing.FileStatuses.FileStatus.item"
+            else:
+                itemPrefix = "FileStatuses.FileStatus.item"
+            trailer = { "DirectoryListing.remainingEntries": 0 }
+            count = 0
+            try:
+                for f in parseJsonItems(resp, itemPrefix, trailer):
+                    count += 1
+                    if batch:
+                        startAfter = f['pathSuffix']
+                    elif count <= yielded:
+                        continue
+                    else:
+                        yielded = count
+                    yield self.toDirEntry(f)
+            except Exception as e:
+                if not isBrokenRead(e):
+                    raise
+                resp.close()
+                if not self.canRetry(attempt):
+                    error("Unable to read listing of '{0}' from '{1}': {2}", path, url, e)
+                self.failover(urlparse.urlparse(resp.url).netloc)
+                self.backoff('connection', attempt)
+                attempt += 1
+            else:
+                if not batch or count == 0 or trailer["DirectoryListing.remainingEntries"] == 0:
+                    return
+                attempt = 0
+            (batch, url, resp) = self.requestDirPage(path, startAfter)
+            if resp.status_code != 200:
+                error("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
+
+    def toDirEntry(self, f):
+        if f['type'] == 'FILE':
+            fi = {}
+            fi['type'] = 'FILE'
+            fi['name'] = f['pathSuffix']
+            fi['size'] = f['length']
+            fi['modificationTime'] = f['modificationTime']/1000
+            fi['mode'] = "0" + f['permission']
+            fi['owner'] = f['owner']
+            fi['group'] = f['group']
+            fi['blockSize'] = f['blockSize']
+            return fi
+        elif f['type'] == 'DIRECTORY':
+            di = {}
+            di['type'] = 'DIRECTORY'
+            di['name'] = f['pathSuffix']
+            #di['modificationTime'] = f['modificationTime']/1000
+            di['mode'] = "0" + f['permission']
+            di['owner'] = f['owner']
+            di['group'] = f['group']
+            return di
+        else:
+            error("Unknown directory entry type: {0}".format(f['type']))
+
+
+def parseJsonItems(resp, itemPrefix, scalars):
+    """ Yield each object of the array at itemPrefix. Fill 'scalars' with value found at its keys prefix.
+        Use incremental decoding if ijson is available, to avoid loading the whole response in memory """
+    if HAS_IJSON:
+        resp.raw.decode_content = True
+        builder = None
+        for prefix, event, value in ijson.parse(resp.raw):
+            if builder != None:
+                builder.event(event, value)
+                if prefix == itemPrefix and event == 'end_map':
+                    yield builder.value
+                    builder = None
+            elif prefix == itemPrefix and event == 'start_map':
+                builder = ijson.common.ObjectBuilder()
+                builder.event(event, value)
+            elif prefix in scalars:
+                scalars[prefix] = value
+    else:
+        result = resp.json()
+        for prefix in scalars:
+            node = result
+            for key in prefix.split("."):
+                node = node.get(key) if isinstance(node, dict) else None
+            if node != None:
+                scalars[prefix] = node
+        node = result
+        for key in itemPrefix.split(".")[:-1]:
+            node = node[key]
+        for f in node:
+            yield f
     
 
 webHDFS = None
@@ -316,11 +1262,177 @@ def cleanup():
         webHDFS.close()
     
 
+class WorkerError(Exception):
+    pass
+
+class TransferError(Exception):
+    """ Unexpected answer of a Datanode to a data transfer """
+    pass
+
+def getRemoteException(resp):
+    """ Exception name of a WebHDFS error response (i.e. 'StandbyException'). None if not provided """
+    try:
+        return resp.json()['RemoteException']['exception']
+    except Exception:
+        return None
+
+def isNotSent(e):
+    """ True if a requests exception occurred before the request reached the server """
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(e, requests.exceptions.ConnectionError) and type(reason).__name__ == "NewConnectionError"
+
+def isBrokenRead(e):
+    """ True if an exception occurred while reading or decoding a streamed response body (connection reset, read timeout, truncated content) """
+    if isinstance(e, (requests.exceptions.RequestException, requests.packages.urllib3.exceptions.HTTPError, httplib.HTTPException, socket.error, ValueError)):
+        return True
+    return HAS_IJSON and isinstance(e, ijson.common.JSONError)
+
+mainThread = threading.current_thread()
+
 def error(message, *args):
     x = "" + message.format(*args)
+    if threading.current_thread() is not mainThread:
+        # Raised in a worker thread. Will be collected by runTasks() and reported from the main thread.
+        raise WorkerError(x)
     cleanup()
     module.fail_json(msg = x)    
 
+
+def runTasks(tasks, parallelism, deadline = None):
+    """ Run a list of (key, function, args) on a bounded pool of worker threads. Return a list of (key, errorMessage).
+        deadline: None, or a Deadline. Tasks not started once reached are skipped """
+    failures = []
+    if parallelism <= 1:
+        for (key, func, args) in tasks:
+            if deadline == None or deadline.admit(key):
+                func(*args)
+        return failures
+    queue = Queue.Queue()
+    for task in tasks:
+        queue.put(task)
+    lock = threading.Lock()
+    def worker():
+        while True:
+            try:
+                (key, func, args) = queue.get_nowait()
+            except Queue.Empty:
+                return
+            if deadline != None and not deadline.admit(key):
+                continue
+            try:
+                func(*args)
+            except Exception as e:
+                with lock:
+                    failures.append((key, str(e)))
+    workers = []
+    for _ in range(min(parallelism, len(tasks))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        workers.append(t)
+    for t in workers:
+        t.join()
+    return failures
+
+
+def failOnErrors(failures, what):
+    """ Report all failures returned by runTasks() at once, aggregated by key """
+    if failures:
+        byKey = {}
+        for (key, msg) in failures:
+            byKey.setdefault(key, []).append(msg)
+        error("{0} {1}: {2}", len(byKey), what, "; ".join("{0}: {1}".format(key, ", ".join(byKey[key])) for key in sorted(byKey)))
+
+
+# Only the first skipped paths are reported
+DEADLINE_MAX_REPORTED = 100
+
+class Deadline:
+    """ Time limit of a run. Once reached, tasks not yet started are skipped and directories not yet listed are left aside. Tasks in progress are completed """
+    def __init__(self, seconds, start):
+        self.seconds = seconds
+        self.end = start + seconds
+        self.lock = threading.Lock()
+        self.started = 0
+        self.skipped = []
+        self.unlisted = []
+        # Some work was not performed
+        self.interrupted = False
+
+    def reached(self):
+        return time.time() >= self.end
+
+    def admit(self, key):
+        """ Return True if the task can be started. Otherwise, record it as skipped """
+        with self.lock:
+            if time.time() >= self.end:
+                self.skipped.append(key)
+                self.interrupted = True
+                return False
+            self.started += 1
+            return True
+
+    def admitListing(self, path):
+        """ Same as admit(), for a directory to list """
+        with self.lock:
+            if time.time() >= self.end:
+                self.unlisted.append(path)
+                self.interrupted = True
+                return False
+            return True
+
+    def getStats(self):
+        with self.lock:
+            return { 'seconds': self.seconds, 'reached': self.reached(), 'interrupted': self.interrupted, 'started_tasks': self.started,
+                     'skipped_tasks': len(self.skipped), 'skipped_paths': sorted(self.skipped)[:DEADLINE_MAX_REPORTED],
+                     'unlisted_directories': len(self.unlisted), 'unlisted_paths': sorted(self.unlisted)[:DEADLINE_MAX_REPORTED] }
+
+
+class TaskPool:
+    """ Same as runTasks(), but tasks are submitted while workers are running """
+    def __init__(self, parallelism, deadline = None):
+        self.queue = Queue.Queue()
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.failures = []
+        self.firstStart = None
+        self.workers = []
+        for _ in range(parallelism):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def worker(self):
+        while True:
+            task = self.queue.get()
+            if task == None:
+                return
+            (key, func, args) = task
+            if self.deadline != None and not self.deadline.admit(key):
+                continue
+            if self.firstStart == None:
+                self.firstStart = time.time()
+            try:
+                func(*args)
+            except Exception as e:
+                with self.lock:
+                    self.failures.append((key, str(e)))
+
+    def submit(self, key, func, args):
+        self.queue.put((key, func, args))
+
+    def join(self):
+        """ Wait for all submitted tasks to be completed. Return a list of (key, errorMessage) """
+        for _ in self.workers:
+            self.queue.put(None)
+        for t in self.workers:
+            t.join()
+        return self.failures
+
+
 class Parameters:
     pass
                 
@@ -344,10 +1456,11 @@ def lookupWebHdfs(p):
                 error("Unable to find {0}* or {1}* in {2}. Provide explicit 'webhdfs_endpoint'", NN_HTTP_TOKEN1, NN_HTTP_TOKEN2, hspath)
             errors = []
             for endpoint in candidates:
-                webHDFS= WebHDFS(endpoint, p.hdfsUser)
+                webHDFS= WebHDFS(endpoint, p.hdfsUser, p.httpPoolConnections, p.httpPoolMaxsize, (p.connectTimeout, p.readTimeout), (p.dataConnectTimeout, p.dataReadTimeout))
                 (x, err) = webHDFS.test()
                 if x:
                     p.webhdfsEndpoint = webHDFS.endpoint
+                    webHDFS.candidates = candidates
                     return webHDFS
                 else:
                     errors.append(err)
@@ -358,10 +1471,11 @@ def lookupWebHdfs(p):
         candidates = p.webhdfsEndpoint.split(",")
         errors = []
         for endpoint in candidates:
-            webHDFS= WebHDFS(endpoint, p.hdfsUser)
+            webHDFS= WebHDFS(endpoint, p.hdfsUser, p.httpPoolConnections, p.httpPoolMaxsize, (p.connectTimeout, p.readTimeout), (p.dataConnectTimeout, p.dataReadTimeout))
             (x, err) = webHDFS.test()
             if x:
                 p.webhdfsEndpoint = webHDFS.endpoint
+                webHDFS.candidates = candidates
                 return webHDFS
             else:
                 errors.append(err)
@@ -389,45 +1503,78 @@ def checkParameters(p):
         p.directoryMode = oct(p.directoryMode)
         #print '{ mode_type: "' + str(type(p.directoryMode)) + '",  directoryMode_value: "' + str(p.directoryMode) + '"}'
 
+    if not isinstance(p.hdfsUmask, int):
+        try:
+            p.hdfsUmask = int(p.hdfsUmask, 8)
+        except Exception:
+            error("hdfs_umask must be in octal form")
+    # Owner of newly created files and directories. Unknown when using Kerberos
+    p.creator = p.hdfsUser if p.hdfsUser != "KERBEROS" else None
+
+    if p.parallelism < 1:
+        error("parallelism must be at least 1")
+    if p.listingParallelism < 1:
+        error("listing_parallelism must be at least 1")
+    if p.localScanParallelism < 1:
+        error("local_scan_parallelism must be at least 1")
+    if p.hdfsBytesPerChecksum < 1:
+        error("hdfs_bytes_per_checksum must be positive")
+    if p.checksumProcesses == None:
+        p.checksumProcesses = multiprocessing.cpu_count()
+    if p.metadataWindow < 1:
+        error("metadata_window must be at least 1")
+    if p.multipartThreshold != None and p.multipartThreshold < 1:
+        error("multipart_threshold must be positive")
+    if p.multipartPartSize < 1:
+        error("multipart_part_size must be positive")
+    if p.multipartParallelism < 1:
+        error("multipart_parallelism must be at least 1")
+    p.pathFilter = PathFilter(p.include, p.exclude, p.useRegex) if p.include or p.exclude else None
+    if p.pipelined and p.localManifest != None:
+        error("local_manifest can't be used with pipelined")
+    if p.pipelined and p.snapshotDiffCache != None:
+        error("snapshot_diff_cache can't be used with pipelined")
+    if p.journal != None and (p.pipelined or p.snapshotDiffCache != None or p.deleteExtraneous):
+        error("journal can't be used with pipelined, snapshot_diff_cache or delete_extraneous")
+    if p.pipelined and p.deleteExtraneous:
+        error("delete_extraneous can't be used with pipelined")
+    if p.backupSnapshots != None and p.backupSnapshots < 1:
+        error("backup_snapshots must be at least 1")
+    if p.maxDeletes < 0:
+        error("max_deletes must be positive or zero")
+    p.httpPoolMaxsize = max(p.httpPoolMaxsize, p.parallelism, p.listingParallelism, p.metadataWindow)
+    if p.multipartThreshold != None:
+        p.httpPoolMaxsize = max(p.httpPoolMaxsize, p.parallelism * p.multipartParallelism)
+    if p.minConcurrency < 1:
+        error("min_concurrency must be at least 1")
+    if p.maxConcurrency == None:
+        # Requests can't be more than connections
+        p.maxConcurrency = max(p.minConcurrency, p.httpPoolMaxsize)
+    if p.maxConcurrency < p.minConcurrency:
+        error("max_concurrency must be at least min_concurrency")
+    if p.targetLatency < 1:
+        error("target_latency must be positive")
+    if p.maxBandwidth != None and p.maxBandwidth < 1:
+        error("max_bandwidth must be positive")
+    if p.maxOpsPerSec != None and p.maxOpsPerSec < 1:
+        error("max_ops_per_sec must be positive")
+    if p.dataConnectTimeout == None:
+        p.dataConnectTimeout = p.connectTimeout
+    if min(p.connectTimeout, p.readTimeout, p.dataConnectTimeout, p.dataReadTimeout) < 1:
+        error("connect_timeout, read_timeout, data_connect_timeout and data_read_timeout must be positive")
+    if p.deadline != None:
+        if p.deadline < 1:
+            error("deadline must be positive")
+        p.deadline = Deadline(p.deadline, p.startTime)
+    if p.maxRetries < 0:
+        error("max_retries must be positive or zero")
+    if p.retryDelay < 0:
+        error("retry_delay must be positive or zero")
+
     if not p.hdfsDest.startswith("/"):
         error("hdfs_dest '{0}' is not absolute. Absolute path is required!", p.path)
 
 
-def applyAttrOnNewFile(webhdfs, path, p):
-    if p.owner != None:
-        webhdfs.setOwner(path,p.owner)
-    if p.group != None:
-        webhdfs.setGroup(path, p.group)
-    if p.mode != None:
-        webhdfs.setPermission(path, p.mode)
-
-
-def applyAttrOnNewDirectory(webhdfs, path, p):
-    if p.owner != None:
-        webhdfs.setOwner(path, p.owner)
-    if p.group != None:
-        webhdfs.setGroup(path, p.group)
-    # Mode is defined at creation
-    
-    
-def adjustAttrOnExistingFile(webhdfs, filePath, fileStatus, p):
-    if p.owner != None and p.owner != fileStatus['owner']:
-        webhdfs.setOwner(filePath, p.owner)
-    if p.group != None and p.group != fileStatus['group']:
-        webhdfs.setGroup(filePath, p.group)
-    if(p.mode != None and fileStatus['mode'] != p.mode):
-        webhdfs.setPermission(filePath, p.mode)
-
-
-def adjustAttrOnExistingDir(webhdfs, dirPath, dirStatus, p):
-    if p.owner != None and p.owner != dirStatus['owner']:
-        webhdfs.setOwner(dirPath, p.owner)
-    if p.group != None and p.group != dirStatus['group']:
-        webhdfs.setGroup(dirPath, p.group)
-    if(p.directoryMode != None and p.directoryMode != dirStatus['mode']):
-        webhdfs.setPermission(dirPath, p.directoryMode)
-
-
 def checkAttrOnExistingFile(fileStatus, p):
     if p.owner != None and p.owner != fileStatus['owner']:
         return True
@@ -450,15 +1597,935 @@ def checkAttrOnExistingDir(dirStatus, p):
 
 
 
+class Op:
+    MKDIRS = "MKDIRS"
+    CREATE = "CREATE"
+    SETTIMES = "SETTIMES"
+    SETOWNER = "SETOWNER"
+    SETPERMISSION = "SETPERMISSION"
+    BACKUP = "BACKUP"
+    APPEND = "APPEND"
+    MULTIPART = "MULTIPART"
+    DELETE = "DELETE"
+
+# Number of HTTP requests issued by each operation. CREATE is redirected from the namenode to a datanode.
+# MULTIPART cost depends on the number of parts. See multipartRpcCost()
+RPC_COST = { Op.MKDIRS: 1, Op.CREATE: 2, Op.SETTIMES: 1, Op.SETOWNER: 1, Op.SETPERMISSION: 1, Op.BACKUP: 1, Op.APPEND: 2, Op.MULTIPART: 0, Op.DELETE: 1 }
+
+
+def countOps(ops, naive, p):
+    """ naive is the cost of issuing one call per attribute, as if no planning was performed """
+    p.rpcPlanned += sum(RPC_COST[op[0]] for op in ops)
+    p.rpcNaive += naive
+
+
+def planNewFile(srcPath, destPath, modTime, overwrite, backup, parentGroup, p):
+    """ parentGroup is the group the target directory will have when the file is created (None if unknown). HDFS makes new files inherit it """
+    ops = []
+    naive = RPC_COST[Op.CREATE] + RPC_COST[Op.SETTIMES]
+    if backup:
+        naive += 1
+        if p.backupMode == BackupMode.SNAPSHOT:
+            # Previous version will be in a snapshot taken before the first write. See takeBackupSnapshot()
+            p.backupNeeded = True
+        else:
+            ops.append((Op.BACKUP, destPath))
+    # Permission provided on CREATE is subject to cluster umask. Only use it when not altered
+    permission = None
+    if p.mode != None and (int(p.mode, 8) & p.hdfsUmask) == 0:
+        permission = p.mode
+    verify = (p.hdfsChecksumType, p.hdfsBytesPerChecksum) if p.verify else None
+    if p.multipartThreshold != None and os.path.getsize(srcPath) >= p.multipartThreshold:
+        ops.append((Op.MULTIPART, destPath, srcPath, overwrite, permission, verify, p.multipartPartSize, p.multipartParallelism, p.multipartStats))
+        p.multipartStats.files += 1
+        p.rpcPlanned += multipartRpcCost(os.path.getsize(srcPath), p.multipartPartSize)
+        naive -= RPC_COST[Op.CREATE]
+    else:
+        ops.append((Op.CREATE, destPath, srcPath, overwrite, permission, verify))
+    ops.append((Op.SETTIMES, destPath, modTime))
+    owner = p.owner if p.owner != None and p.owner != p.creator else None
+    group = p.group if p.group != None and p.group != parentGroup else None
+    if owner != None or group != None:
+        ops.append((Op.SETOWNER, destPath, owner, group))
+    if p.mode != None and permission == None:
+        ops.append((Op.SETPERMISSION, destPath, p.mode))
+    naive += (p.owner != None) + (p.group != None) + (p.mode != None)
+    countOps(ops, naive, p)
+    if p.verify:
+        # GETFILECHECKSUM
+        p.rpcPlanned += 1
+        p.rpcNaive += 1
+    return ops
+
+
+def planAdjust(path, status, mode, p):
+    ops = []
+    owner = p.owner if p.owner != None and p.owner != status['owner'] else None
+    group = p.group if p.group != None and p.group != status['group'] else None
+    if owner != None or group != None:
+        ops.append((Op.SETOWNER, path, owner, group))
+    if mode != None and mode != status['mode']:
+        ops.append((Op.SETPERMISSION, path, mode))
+    countOps(ops, (owner != None) + (group != None) + (mode != None and mode != status['mode']), p)
+    return ops
+
+
+def planAdjustFile(filePath, fileStatus, p):
+    return planAdjust(filePath, fileStatus, p.mode, p)
+
+
+def planAppendFile(srcPath, destPath, modTime, srcSize, fileStatus, p):
+    """ HDFS file is a prefix of the local one. Only send the tail """
+    ops = [(Op.APPEND, destPath, srcPath, fileStatus['size'], srcSize - fileStatus['size']), (Op.SETTIMES, destPath, modTime)]
+    if p.backup:
+        p.backupNeeded = True
+    countOps(ops, RPC_COST[Op.CREATE] + RPC_COST[Op.SETTIMES], p)
+    if p.forceExt:
+        ops.extend(planAdjustFile(destPath, fileStatus, p))
+    p.appendedFiles += 1
+    p.appendSavedBytes += fileStatus['size']
+    return ops
+
+
+def planTouchFile(filePath, modTime, fileStatus, p):
+    """ File content is identical. Only modification time (and attributes, if allowed) need to be fixed """
+    ops = [(Op.SETTIMES, filePath, modTime)]
+    countOps(ops, 1, p)
+    if p.forceExt:
+        ops.extend(planAdjustFile(filePath, fileStatus, p))
+    return ops
+
+
+def planAdjustDir(dirPath, dirStatus, p):
+    return planAdjust(dirPath, dirStatus, p.directoryMode, p)
+
+
+def planDeletes(srcTree, destTree, p):
+    """ Files and directories of the target missing in the source. As DELETE is recursive, only the highest ones are deleted.
+        A directory holding entries excluded by filters, or which could not be listed, is kept and only its extraneous content is deleted.
+        Nothing is deleted under local paths which could not be read.
+        Return operations and the number of deleted entries """
+    unreadable = srcTree['unreadable']
+    if "" in unreadable:
+        return ([], 0)
+    def isUnreadable(path):
+        while path != "":
+            if path in unreadable:
+                return True
+            path = os.path.dirname(path)
+        return False
+    # The target root is never deleted
+    extraneousDirs = set(d for d in destTree['directories'] if d not in srcTree['directories'] and os.path.join(destTree['rroot'], d) != destTree['rroot']
+                         and not isUnreadable(d))
+    # Files of the target missing in the source
+    extraneousFiles = [ f for f in diffFileTables(destTree['files'], srcTree['files'], p)[0] if not isUnreadable(f) ]
+    prefLen = len(destTree['rroot']) if destTree['rroot'] == "/" else len(destTree['rroot']) + 1
+    kept = set()
+    for d in list(destTree['filtered']) + [ x[prefLen:] for x in destTree['noAccess'] ] + list(unreadable):
+        while d != "" and d not in kept:
+            kept.add(d)
+            d = os.path.dirname(d)
+    def covered(path):
+        parent = os.path.dirname(path)
+        return parent in extraneousDirs and parent not in kept
+    ops = []
+    for path in sorted(extraneousDirs) + extraneousFiles:
+        if path not in kept and not covered(path):
+            ops.append((Op.DELETE, os.path.join(destTree['rroot'], path)))
+    count = len(extraneousDirs - kept) + len(extraneousFiles)
+    countOps(ops, count, p)
+    return (ops, count)
+
+
+def lookupGroup(path, groups):
+    while path not in groups:
+        if path == "/" or path == "":
+            return None
+        path = os.path.dirname(path)
+    return groups[path]
+
+
+def planNewDirectories(directories, currentGroups, p):
+    """ directories: Sorted list of absolute path. currentGroups: group of existing directories, by absolute path.
+        Return operations and the group each new directory will have once created """
+    mkdirsOps = []
+    attrOps = []
+    newGroups = {}
+    naive = 0
+    # MKDIRS create missing parents. So only leaves need to be created explicitly
+    parents = set(os.path.dirname(d) for d in directories)
+    for d in directories:
+        naive += 1 + (p.owner != None) + (p.group != None)
+        if d not in parents:
+            mkdirsOps.append((Op.MKDIRS, d, p.directoryMode))
+        elif p.directoryMode != None and (int(p.directoryMode, 8) & 0300) != 0300:
+            # Implicitly created parents get u+wx added to the requested permission
+            attrOps.append((Op.SETPERMISSION, d, p.directoryMode))
+        # All directories created by the same MKDIRS inherit the group of the nearest existing ancestor
+        groupAtCreation = lookupGroup(d, currentGroups)
+        owner = p.owner if p.owner != None and p.owner != p.creator else None
+        group = p.group if p.group != None and p.group != groupAtCreation else None
+        if owner != None or group != None:
+            attrOps.append((Op.SETOWNER, d, owner, group))
+        newGroups[d] = p.group if p.group != None else groupAtCreation
+    ops = mkdirsOps + attrOps
+    countOps(ops, naive, p)
+    return (ops, newGroups)
+
+
+def executeOps(webhdfs, ops):
+    for op in ops:
+        if op[0] == Op.MKDIRS:
+            webhdfs.createFolder(op[1], op[2])
+        elif op[0] == Op.CREATE:
+            if op[5] != None:
+                putFileAndVerify(webhdfs, op[2], op[1], op[3], op[4], op[5])
+            else:
+                webhdfs.putFileToHdfs(op[2], op[1], op[3], op[4], None)
+        elif op[0] == Op.SETTIMES:
+            webhdfs.setModificationTime(op[1], op[2])
+        elif op[0] == Op.SETOWNER:
+            webhdfs.setOwner(op[1], op[2], op[3])
+        elif op[0] == Op.SETPERMISSION:
+            webhdfs.setPermission(op[1], op[2])
+        elif op[0] == Op.BACKUP:
+            backupHdfsFile(webhdfs, op[1])
+        elif op[0] == Op.APPEND:
+            webhdfs.appendToHdfs(op[2], op[1], op[3], op[4])
+        elif op[0] == Op.MULTIPART:
+            putFileMultipart(webhdfs, op[2], op[1], op[3], op[4], op[5], op[6], op[7], op[8])
+        elif op[0] == Op.DELETE:
+            webhdfs.delete(op[1])
+        else:
+            error("Unknown operation '{0}'", op[0])
+
+
+class BackupMode:
+    RENAME = "rename"
+    SNAPSHOT = "snapshot"
+
+BACKUP_SNAPSHOT_PREFIX = "hdfs_put-backup-"
+
+def takeBackupSnapshot(webhdfs, path, p):
+    """ A single snapshot of path saves all files about to be replaced, appended or deleted. Then, only the most recent backup snapshots are kept """
+    name = "{0}{1}".format(BACKUP_SNAPSHOT_PREFIX, int(time.time() * 1000))
+    if not webhdfs.createSnapshot(path, name):
+        error("{0} is not snapshottable. Required by backup_mode=snapshot", path)
+    p.rpcPlanned += 1
+    p.backupSnapshot = os.path.join(path, ".snapshot", name)
+    if p.backupSnapshots != None:
+        backups = sorted(x for x in webhdfs.listSnapshots(path) if x.startswith(BACKUP_SNAPSHOT_PREFIX))
+        for x in backups[:-p.backupSnapshots]:
+            webhdfs.deleteSnapshot(path, x)
+
+
 def backupHdfsFile(webhdfs, path):
     #ext = time.strftime("%Y-%m-%d@%H:%M:%S", time.localtime(time.time()))
     ext = time.strftime("%Y-%m-%d_%H_%M_%S~", time.localtime(time.time()))
     backupdest = '%s.%s' % (path, ext)
-    webhdfs.rename(path, backupdest)
+    if not webhdfs.rename(path, backupdest):
+        error("Unable to rename '{0}' to '{1}' for backup", path, backupdest)
     
 
 
-def buildLocalTree(rroot):
+class Compare:
+    SIZE_MTIME = "size_mtime"
+    CHECKSUM = "checksum"
+
+
+CRC32C_TABLE = []
+for _i in range(256):
+    _c = _i
+    for _ in range(8):
+        _c = (_c >> 1) ^ 0x82F63B78 if _c & 1 else _c >> 1
+    CRC32C_TABLE.append(_c)
+
+def pyCrc32c(data, crc):
+    """ Slow fallback, used only if the crc32c package is not installed """
+    crc ^= 0xFFFFFFFF
+    for b in bytearray(data):
+        crc = CRC32C_TABLE[(crc ^ b) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+def getCrcFunction(crcType):
+    if crcType == "CRC32":
+        return lambda data, crc: zlib.crc32(data, crc) & 0xFFFFFFFF
+    if HAS_CRC32C:
+        # SSE4.2 / table based C implementation
+        return getattr(crc32c, "crc32c", None) or crc32c.crc32
+    return pyCrc32c
+
+
+MD5MD5CRC_PATTERN = re.compile(r"^MD5-of-(\d+)MD5-of-(\d+)(CRC32C?)$")
+COMPOSITE_CRC_PATTERN = re.compile(r"^COMPOSITE-(CRC32C?)$")
+# Size of mmap slices used to compute a whole file composite CRC
+COMPOSITE_SLICE = 8 * 1024 * 1024
+
+def parseHdfsChecksum(fileChecksum):
+    """ Return (crcType, bytesPerCrc, value, crcPerBlock) or None if algorithm is unknown. bytesPerCrc and crcPerBlock are None for composite CRC.
+        crcPerBlock is 0 for single block files """
+    m = MD5MD5CRC_PATTERN.match(fileChecksum['algorithm'])
+    if m != None:
+        # bytesPerCRC (4 bytes), crcPerBlock (8 bytes), then file MD5
+        return (m.group(3), int(m.group(2)), fileChecksum['bytes'][24:56], int(m.group(1)))
+    m = COMPOSITE_CRC_PATTERN.match(fileChecksum['algorithm'])
+    if m != None:
+        return (m.group(1), None, fileChecksum['bytes'][0:8], None)
+    return None
+
+def computeLocalChecksum(args):
+    """ Compute the checksum HDFS would report for the first 'length' bytes of a local file, in the same form as parseHdfsChecksum() value.
+        Run in a worker process. Return None if the file is now shorter than 'length' (truncated since it was scanned) """
+    (path, crcType, bytesPerCrc, blockSize, length) = args
+    crcFunction = getCrcFunction(crcType)
+    f = open(path, "rb")
+    try:
+        fileSize = os.fstat(f.fileno()).st_size
+        if fileSize < length or fileSize == 0:
+            # Can't match. An empty file can't be mapped
+            return None
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            size = min(len(data), length)
+            if bytesPerCrc == None:
+                # Composite CRC does not depend on block layout. This is the CRC of the whole file
+                crc = 0
+                for offset in xrange(0, size, COMPOSITE_SLICE):
+                    crc = crcFunction(data[offset:offset + COMPOSITE_SLICE], crc)
+                return "%08x" % crc
+            # MD5 of the concatenation of each block MD5, which is the MD5 of the concatenation of each chunk CRC
+            blockMd5s = []
+            for blockStart in xrange(0, size, blockSize):
+                blockEnd = min(blockStart + blockSize, size)
+                crcs = [ struct.pack(">I", crcFunction(data[offset:min(offset + bytesPerCrc, blockEnd)], 0)) for offset in xrange(blockStart, blockEnd, bytesPerCrc) ]
+                blockMd5s.append(hashlib.md5("".join(crcs)).digest())
+            return hashlib.md5("".join(blockMd5s)).hexdigest()
+        finally:
+            data.close()
+    finally:
+        f.close()
+
+
+class ChecksumReader:
+    """ Wrap an upload source file. Record chunk CRCs of data as it is read, to compute HDFS checksum afterward without reading the file again.
+        CRC are kept in a compact array (4 bytes per chunk), as block size is only known once the file is created """
+    
+    def __init__(self, f, size, crcType, bytesPerCrc):
+        self.f = f
+        self.len = size     # Allow requests to set Content-Length
+        self.crcType = crcType
+        self.crcFunction = getCrcFunction(crcType)
+        self.bytesPerCrc = bytesPerCrc
+        self.crcs = array.array('I')
+        self.fileCrc = 0
+        self.pending = ""
+        
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.fileCrc = self.crcFunction(data, self.fileCrc)
+        buf = self.pending + data if self.pending else data
+        end = len(buf) - (len(buf) % self.bytesPerCrc)
+        for offset in xrange(0, end, self.bytesPerCrc):
+            self.crcs.append(self.crcFunction(buf[offset:offset + self.bytesPerCrc], 0))
+        self.pending = buf[end:]
+        return data
+    
+    def __iter__(self):
+        while True:
+            data = self.read(64 * 1024)
+            if not data:
+                return
+            yield data
+
+    def finish(self):
+        if self.pending:
+            self.crcs.append(self.crcFunction(self.pending, 0))
+            self.pending = ""
+
+    def matches(self, fileChecksum):
+        """ Return None if fileChecksum (as provided by HDFS) match read data, or the reason why not """
+        remote = parseHdfsChecksum(fileChecksum)
+        if remote == None:
+            return "Unknown checksum algorithm '{0}'".format(fileChecksum['algorithm'])
+        if remote[0] != self.crcType:
+            return "HDFS checksum type is {0}. Set hdfs_checksum_type accordingly".format(remote[0])
+        if remote[1] == None:
+            local = "%08x" % self.fileCrc
+        else:
+            if remote[1] != self.bytesPerCrc:
+                return "HDFS bytes per checksum is {0}. Set hdfs_bytes_per_checksum accordingly".format(remote[1])
+            crcPerBlock = remote[3] if remote[3] > 0 else max(len(self.crcs), 1)
+            blockMd5s = []
+            for first in xrange(0, len(self.crcs), crcPerBlock):
+                blockMd5s.append(hashlib.md5("".join(struct.pack(">I", crc) for crc in self.crcs[first:first + crcPerBlock])).digest())
+            local = hashlib.md5("".join(blockMd5s)).hexdigest()
+        if local != remote[2]:
+            return "Checksum mismatch"
+        return None
+
+
+class FileSlice:
+    """ Expose 'length' bytes of an opened file, starting at 'offset', as an upload source """
+    
+    def __init__(self, f, offset, length):
+        self.f = f
+        self.f.seek(offset)
+        self.len = length     # Allow requests to set Content-Length
+        self.remaining = length
+        
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(64 * 1024)
+            if not data:
+                return
+            yield data
+
+
+def putFileAndVerify(webhdfs, srcPath, destPath, overwrite, permission, verify):
+    """ Upload, then compare checksum of sent data with the one computed by HDFS. Retry once on mismatch """
+    for attempt in range(2):
+        reader = webhdfs.putFileToHdfs(srcPath, destPath, overwrite or attempt > 0, permission, verify)
+        if reader.len == 0:
+            return
+        fileChecksum = webhdfs.getFileChecksum(destPath)
+        if fileChecksum == None:
+            error("Unable to get checksum of '{0}'", destPath)
+        reason = reader.matches(fileChecksum)
+        if reason == None:
+            return
+        if not reason.startswith("Checksum mismatch"):
+            break
+    error("Verification of '{0}' failed: {1}", destPath, reason)
+
+
+# Maximum number of parts provided to a single CONCAT, to keep URL length reasonable
+MULTIPART_CONCAT_BATCH = 100
+
+class MultipartStats:
+    """ Updated concurrently by copy workers """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = 0
+        self.uploadedParts = 0
+        self.resumedParts = 0
+        
+    def addPart(self, resumed):
+        with self.lock:
+            if resumed:
+                self.resumedParts += 1
+            else:
+                self.uploadedParts += 1
+
+
+def multipartRpcCost(size, partSize):
+    partCount = max(1, (size + partSize - 1) / partSize)
+    # Status of first part, then for each part status and CREATE. Then CONCAT(s) and RENAME
+    return 1 + partCount * (1 + RPC_COST[Op.CREATE]) + (partCount - 1 + MULTIPART_CONCAT_BATCH - 1) / MULTIPART_CONCAT_BATCH + 1
+
+
+def getMultipartParts(srcPath, destPath, partSize):
+    """ Return a list of (hdfsPath, offset, length). Parts are located in the target directory, as required by CONCAT.
+        Their names include source size and modification time, so parts of a previous version of the file are never reused """
+    stat = os.stat(srcPath)
+    prefix = os.path.join(os.path.dirname(destPath), ".{0}.{1}_{2}.part".format(os.path.basename(destPath), stat.st_size, int(stat.st_mtime)))
+    partCount = max(1, (stat.st_size + partSize - 1) / partSize)
+    return [ ("{0}{1:05d}".format(prefix, i), i * partSize, min(partSize, stat.st_size - i * partSize)) for i in range(partCount) ]
+
+
+def putFileMultipart(webhdfs, srcPath, destPath, overwrite, permission, verify, partSize, parallelism, stats):
+    """ Upload parts in parallel, then CONCAT them into the first one, which is finally renamed.
+        Parts left by a previous failed run are kept if complete. On checksum mismatch, all parts are uploaded again once """
+    parts = getMultipartParts(srcPath, destPath, partSize)
+    size = parts[-1][1] + parts[-1][2]
+    for attempt in range(2):
+        uploadParts(webhdfs, srcPath, parts, size, permission, parallelism, stats, attempt == 0)
+        if not webhdfs.rename(parts[0][0], destPath, overwrite or attempt > 0):
+            webhdfs.delete(parts[0][0])
+            error("Unable to rename '{0}' to '{1}' (Target exists and overwrite is not allowed?)", parts[0][0], destPath)
+        if verify == None:
+            return
+        reason = verifyMultipart(webhdfs, srcPath, destPath, size, partSize)
+        if reason == None:
+            return
+        if not reason.startswith("Checksum mismatch"):
+            break
+    error("Verification of '{0}' failed: {1}", destPath, reason)
+
+
+def uploadParts(webhdfs, srcPath, parts, size, permission, parallelism, stats, resume):
+    """ Upload and CONCAT parts into the first one. If resume, complete parts (or first part already holding the whole file) are not sent again """
+    if resume:
+        (firstType, firstStatus) = webhdfs.getPathTypeAndStatus(parts[0][0])
+        if firstType == 'FILE' and firstStatus['size'] == size:
+            # A previous run has concatenated all parts, but failed before renaming
+            return
+    def uploadPart(partPath, offset, length):
+        if resume:
+            (partType, partStatus) = webhdfs.getPathTypeAndStatus(partPath)
+            if partType == 'FILE' and partStatus['size'] == length:
+                stats.addPart(True)
+                return
+        webhdfs.putPartToHdfs(srcPath, partPath, offset, length, permission)
+        stats.addPart(False)
+    failOnErrors(runTasks([(part[0], uploadPart, part) for part in parts], parallelism), "part(s) failed to be uploaded")
+    sources = [ part[0] for part in parts[1:] ]
+    for first in xrange(0, len(sources), MULTIPART_CONCAT_BATCH):
+        webhdfs.concat(parts[0][0], sources[first:first + MULTIPART_CONCAT_BATCH])
+
+
+def verifyMultipart(webhdfs, srcPath, destPath, size, partSize):
+    """ Return None if HDFS checksum of destPath match the local file, or the reason why not.
+        Local file is read again, as parts are sent concurrently, and may have been uploaded by a previous run """
+    fileChecksum = webhdfs.getFileChecksum(destPath)
+    if fileChecksum == None:
+        error("Unable to get checksum of '{0}'", destPath)
+    remote = parseHdfsChecksum(fileChecksum)
+    if remote == None:
+        return "Unknown checksum algorithm '{0}'".format(fileChecksum['algorithm'])
+    (_, destStatus) = webhdfs.getPathTypeAndStatus(destPath)
+    if remote[1] != None and partSize % destStatus['blockSize'] != 0:
+        # Each part ends with a partial block, which is kept as is by CONCAT
+        error("Unable to verify '{0}': multipart_part_size is not a multiple of HDFS block size ({1})", destPath, destStatus['blockSize'])
+    if computeLocalChecksum((srcPath, remote[0], remote[1], destStatus['blockSize'], size)) != remote[2]:
+        return "Checksum mismatch"
+    return None
+
+
+def computeInProcesses(function, jobs, processes):
+    """ Return [ function(job) for job in jobs ], computed by a pool of forked processes (in this process if a single one).
+        Unlike multiprocessing.Pool, function is inherited by fork and not pickled, as this module may not be importable by name """
+    if processes <= 1:
+        results = []
+        failures = []
+        for job in jobs:
+            try:
+                results.append(function(job))
+            except Exception as e:
+                results.append(None)
+                failures.append((job[0], str(e)))
+        failOnErrors(failures, "local file(s) checksum could not be computed")
+        return results
+    jobQueue = multiprocessing.Queue()
+    resultQueue = multiprocessing.Queue()
+    for i in range(len(jobs)):
+        jobQueue.put((i, jobs[i]))
+    for _ in range(processes):
+        jobQueue.put(None)
+    def worker():
+        while True:
+            x = jobQueue.get()
+            if x == None:
+                return
+            try:
+                resultQueue.put((x[0], function(x[1]), None))
+            except Exception as e:
+                resultQueue.put((x[0], None, str(e)))
+    workers = []
+    for _ in range(processes):
+        w = multiprocessing.Process(target=worker)
+        w.daemon = True
+        w.start()
+        workers.append(w)
+    results = [None] * len(jobs)
+    failures = []
+    pending = set(range(len(jobs)))
+    while pending:
+        # Checked before waiting, so results of workers which exited are already readable
+        alive = any(w.is_alive() for w in workers)
+        try:
+            (i, result, err) = resultQueue.get(timeout=1)
+        except Queue.Empty:
+            if not alive:
+                # Some worker died (i.e. killed when out of memory). Its job will never be done
+                break
+            continue
+        pending.discard(i)
+        results[i] = result
+        if err != None:
+            failures.append((jobs[i][0], err))
+    for i in sorted(pending):
+        failures.append((jobs[i][0], "Worker process exited unexpectedly (exit codes: {0})".format(",".join(str(w.exitcode) for w in workers))))
+    for w in workers:
+        w.join()
+    failOnErrors(failures, "local file(s) checksum could not be computed")
+    return results
+
+
+def findIdenticalFiles(webhdfs, candidates, p):
+    """ candidates: list of (key, srcPath, destPath, blockSize, length). Return the set of keys where the HDFS file is identical to the 'length' first bytes of the local one.
+        Remote checksums are fetched in parallel, local ones computed on a pool of processes """
+    remoteChecksums = {}
+    def fetch(key, destPath):
+        fileChecksum = webhdfs.getFileChecksum(destPath)
+        if fileChecksum != None:
+            remoteChecksums[key] = parseHdfsChecksum(fileChecksum)
+    failOnErrors(runTasks([(c[0], fetch, (c[0], c[2])) for c in candidates], p.parallelism), "file(s) checksum could not be fetched")
+    keys = []
+    jobs = []
+    identical = set()
+    for (key, srcPath, destPath, blockSize, length) in candidates:
+        remote = remoteChecksums.get(key)
+        if remote != None:
+            job = (srcPath, remote[0], remote[1], blockSize, length)
+            cached = p.checksumCache.get(srcPath)
+            if cached != None and cached[0] == checksumSignature(job):
+                # Known from local manifest
+                if cached[1] == remote[2]:
+                    identical.add(key)
+            else:
+                keys.append(key)
+                jobs.append(job)
+    localChecksums = computeInProcesses(computeLocalChecksum, jobs, min(p.checksumProcesses, len(jobs)))
+    for (key, job, localChecksum) in zip(keys, jobs, localChecksums):
+        if localChecksum == None:
+            # Truncated since scanned. Will be replaced
+            continue
+        p.checksumCache[job[0]] = (checksumSignature(job), localChecksum)
+        if localChecksum == remoteChecksums[key][2]:
+            identical.add(key)
+    return identical
+
+
+def checksumSignature(job):
+    """ What a local checksum depends on, beside file content """
+    (srcPath, crcType, bytesPerCrc, blockSize, length) = job
+    if bytesPerCrc == None:
+        return "{0}:{1}".format(crcType, length)
+    return "{0}:{1}:{2}:{3}".format(crcType, bytesPerCrc, blockSize, length)
+
+
+class AppendDetection:
+    NO = "no"
+    CHECKSUM = "checksum"
+    SAMPLE = "sample"
+
+# Size and number of ranges compared when checking a prefix by sampling. First and last ranges are always included
+APPEND_SAMPLE_SIZE = 64 * 1024
+APPEND_SAMPLE_COUNT = 8
+
+def samplePrefixMatches(webhdfs, srcPath, destPath, length):
+    ranges = set([ (0, min(APPEND_SAMPLE_SIZE, length)) ])
+    if length > APPEND_SAMPLE_SIZE:
+        step = (length - APPEND_SAMPLE_SIZE) / (APPEND_SAMPLE_COUNT - 1)
+        for i in range(1, APPEND_SAMPLE_COUNT):
+            ranges.add((i * step if i < APPEND_SAMPLE_COUNT - 1 else length - APPEND_SAMPLE_SIZE, APPEND_SAMPLE_SIZE))
+    f = open(srcPath, "rb")
+    try:
+        for (offset, size) in sorted(ranges):
+            f.seek(offset)
+            if f.read(size) != webhdfs.readRange(destPath, offset, size):
+                return False
+    finally:
+        f.close()
+    return True
+
+
+def isAppendCandidate(srcSize, destSize, p):
+    # A backup by renaming must preserve previous version. So a full copy is needed
+    return p.appendDetection != AppendDetection.NO and p.force and not (p.backup and p.backupMode == BackupMode.RENAME) and srcSize > destSize
+
+
+def findAppendableFiles(webhdfs, candidates, p):
+    """ candidates: list of (key, srcPath, destPath, blockSize, destSize) for local files longer than HDFS ones.
+        Return the set of keys where the HDFS file is a prefix of the local one """
+    if p.appendDetection == AppendDetection.CHECKSUM:
+        withContent = [ c for c in candidates if c[4] > 0 ]
+        appendable = findIdenticalFiles(webhdfs, withContent, p)
+    else:
+        appendable = set()
+        def check(key, srcPath, destPath, length):
+            if length == 0 or samplePrefixMatches(webhdfs, srcPath, destPath, length):
+                appendable.add(key)
+        failOnErrors(runTasks([(c[0], check, (c[0], c[1], c[2], c[4])) for c in candidates], p.parallelism), "file(s) could not be sampled")
+    # Empty files are a prefix of anything
+    for c in candidates:
+        if c[4] == 0:
+            appendable.add(c[0])
+    return appendable
+
+
+class FileTable:
+    """ Files of a tree, by path relative to its root. Read as a dict of file status, but stored by columns: Directory part of each path is interned,
+        size, modification time and block size are typed arrays, and mode, owner and group are indexes in a pool of distinct values.
+        Rows are sorted by directory then name on first read after insertion, so files of a directory are contiguous """
+    def __init__(self, files = None):
+        self.dirIds = {}
+        self.dirNames = []
+        self.dirs = array.array('l')
+        self.names = []
+        self.sizes = array.array('l')
+        self.mtimes = array.array('l')
+        self.blockSizes = array.array('l')
+        self.modes = array.array('l')
+        self.owners = array.array('l')
+        self.groups = array.array('l')
+        # Index 0 is None, for missing values
+        self.poolIds = { None: 0 }
+        self.pool = [ None ]
+        # Index of the first row of each directory, plus total number of rows
+        self.bounds = array.array('l', [ 0 ])
+        self.isSorted = True
+        if files != None:
+            self.update(files)
+
+    def valueId(self, value):
+        """ Index of value in the pool, -1 if not present """
+        return self.poolIds.get(value, -1)
+
+    def poolValue(self, value):
+        x = self.poolIds.get(value)
+        if x == None:
+            x = len(self.pool)
+            self.poolIds[value] = x
+            self.pool.append(value)
+        return x
+
+    def __setitem__(self, path, status):
+        (dirName, name) = os.path.split(path)
+        d = self.dirIds.get(dirName)
+        if d == None:
+            d = len(self.dirNames)
+            self.dirIds[dirName] = d
+            self.dirNames.append(dirName)
+        self.dirs.append(d)
+        self.names.append(name)
+        self.sizes.append(status['size'])
+        self.mtimes.append(status['modificationTime'])
+        self.blockSizes.append(status.get('blockSize', -1))
+        self.modes.append(self.poolValue(status.get('mode')))
+        self.owners.append(self.poolValue(status.get('owner')))
+        self.groups.append(self.poolValue(status.get('group')))
+        self.isSorted = False
+
+    def update(self, files):
+        for (path, status) in files.iteritems():
+            self[path] = status
+
+    def sortRows(self):
+        if self.isSorted:
+            return
+        # Directory ids are renumbered in directory name order. Sort by name, then by directory: sort is stable
+        dirOrder = sorted(xrange(len(self.dirNames)), key=self.dirNames.__getitem__)
+        rank = array.array('l', [ 0 ]) * len(dirOrder)
+        for (r, d) in enumerate(dirOrder):
+            rank[d] = r
+        order = sorted(xrange(len(self.names)), key=self.names.__getitem__)
+        order.sort(key=lambda i: rank[self.dirs[i]])
+        self.dirNames = [ self.dirNames[d] for d in dirOrder ]
+        self.dirIds = dict((dirName, r) for (r, dirName) in enumerate(self.dirNames))
+        self.dirs = array.array('l', (rank[self.dirs[i]] for i in order))
+        self.names = [ self.names[i] for i in order ]
+        for column in ('sizes', 'mtimes', 'blockSizes', 'modes', 'owners', 'groups'):
+            values = getattr(self, column)
+            setattr(self, column, array.array('l', (values[i] for i in order)))
+        self.bounds = array.array('l')
+        previous = -1
+        for (i, d) in enumerate(self.dirs):
+            if d != previous:
+                self.bounds.append(i)
+                previous = d
+        self.bounds.append(len(self.dirs))
+        self.isSorted = True
+
+    def dirRange(self, dirName):
+        """ (first, last + 1) rows of the files of this directory. None if it has no file """
+        self.sortRows()
+        d = self.dirIds.get(dirName)
+        if d == None:
+            return None
+        return (self.bounds[d], self.bounds[d + 1])
+
+    def find(self, path):
+        (dirName, name) = os.path.split(path)
+        r = self.dirRange(dirName)
+        if r != None:
+            i = bisect.bisect_left(self.names, name, r[0], r[1])
+            if i < r[1] and self.names[i] == name:
+                return i
+        return -1
+
+    def path(self, i):
+        return os.path.join(self.dirNames[self.dirs[i]], self.names[i])
+
+    def status(self, i):
+        """ A new dict, as built by the tree walks """
+        s = { 'size': self.sizes[i], 'modificationTime': self.mtimes[i] }
+        if self.blockSizes[i] >= 0:
+            s['blockSize'] = self.blockSizes[i]
+        for (key, column) in (('mode', self.modes), ('owner', self.owners), ('group', self.groups)):
+            if column[i] != 0:
+                s[key] = self.pool[column[i]]
+        return s
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, path):
+        return self.find(path) >= 0
+
+    def __getitem__(self, path):
+        i = self.find(path)
+        if i < 0:
+            raise KeyError(path)
+        return self.status(i)
+
+    def get(self, path, default = None):
+        i = self.find(path)
+        return self.status(i) if i >= 0 else default
+
+    def __iter__(self):
+        self.sortRows()
+        return (self.path(i) for i in xrange(len(self.names)))
+
+    def iteritems(self):
+        self.sortRows()
+        return ((self.path(i), self.status(i)) for i in xrange(len(self.names)))
+
+    def memoryUsage(self):
+        """ Approximate size in bytes, shared pool values excluded """
+        size = sys.getsizeof(self.names) + sum(sys.getsizeof(name) for name in self.names) + sum(sys.getsizeof(d) for d in self.dirNames)
+        for column in (self.dirs, self.sizes, self.mtimes, self.blockSizes, self.modes, self.owners, self.groups, self.bounds):
+            size += column.buffer_info()[1] * column.itemsize
+        return size
+
+
+def diffFileTables(src, dest, p):
+    """ Return paths of files of src missing in dest, of those with a different size or modification time, and of identical ones whose attributes
+        in dest differ from the requested owner, group and mode. 
+        Both tables are sorted the same way. So a directory whose files are the same on both sides is checked by comparing slices of the name lists
+        and of the typed arrays, which is performed natively. Other directories are merged file by file """
+    src.sortRows()
+    dest.sortRows()
+    wanted = []
+    for (column, value) in ((dest.owners, p.owner), (dest.groups, p.group), (dest.modes, p.mode)):
+        if value != None:
+            wanted.append((column, dest.valueId(value)))
+    missing = []
+    differing = []
+    toAdjust = []
+    for (d, dirName) in enumerate(src.dirNames):
+        (s0, s1) = (src.bounds[d], src.bounds[d + 1])
+        r = dest.dirRange(dirName)
+        if r == None:
+            missing.extend(os.path.join(dirName, name) for name in src.names[s0:s1])
+            continue
+        (d0, d1) = r
+        if src.names[s0:s1] == dest.names[d0:d1]:
+            if (src.sizes[s0:s1] == dest.sizes[d0:d1] and src.mtimes[s0:s1] == dest.mtimes[d0:d1]
+                    and all(column[d0:d1].count(x) == d1 - d0 for (column, x) in wanted)):
+                continue
+            pairs = zip(xrange(s0, s1), xrange(d0, d1))
+        else:
+            pairs = []
+            j = d0
+            for i in xrange(s0, s1):
+                name = src.names[i]
+                while j < d1 and dest.names[j] < name:
+                    j += 1
+                if j < d1 and dest.names[j] == name:
+                    pairs.append((i, j))
+                    j += 1
+                else:
+                    missing.append(os.path.join(dirName, name))
+        for (i, j) in pairs:
+            if src.sizes[i] != dest.sizes[j] or src.mtimes[i] != dest.mtimes[j]:
+                differing.append(os.path.join(dirName, src.names[i]))
+            else:
+                for (column, x) in wanted:
+                    if column[j] != x:
+                        toAdjust.append(os.path.join(dirName, src.names[i]))
+                        break
+    return (missing, differing, toAdjust)
+
+
+def globToRegex(pattern):
+    """ '*' and '?' do not match '/', '**' does. A pattern starting with '/' or with a '/' inside is matched against the whole path.
+        Otherwise, against the last path component. A trailing '/' is ignored """
+    anchored = pattern.startswith("/") or "/" in pattern.strip("/")
+    pattern = pattern.strip("/")
+    res = "" if anchored else "(?:.*/)?"
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            if i < n and pattern[i] == "*":
+                i += 1
+                res += ".*"
+            else:
+                res += "[^/]*"
+        elif c == "?":
+            res += "[^/]"
+        elif c == "[":
+            j = i
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            j = pattern.find("]", j)
+            if j < 0:
+                res += "\\["
+            else:
+                content = pattern[i:j].replace("\\", "\\\\")
+                if content[0] in "!^":
+                    content = "^" + content[1:]
+                res += "[" + content + "]"
+                i = j + 1
+        else:
+            res += re.escape(c)
+    return "^" + res + "$"
+
+
+class PathFilter:
+    """ include and exclude patterns are matched against paths relative to src (or to the target directory). All patterns of a list are
+        compiled into a single regular expression. Excluded directories are pruned, with their content. Include only applies to files """
+    def __init__(self, include, exclude, useRegex):
+        self.signature = json.dumps([ include, exclude, useRegex ])
+        self.include = self.compile(include, useRegex)
+        self.exclude = self.compile(exclude, useRegex)
+
+    def compile(self, patterns, useRegex):
+        if not patterns:
+            return None
+        regexes = []
+        for pattern in patterns:
+            regex = pattern if useRegex else globToRegex(pattern)
+            try:
+                re.compile(regex)
+            except re.error as e:
+                error("Invalid pattern '{0}': {1}", pattern, str(e))
+            regexes.append("(?:{0})".format(regex))
+        return re.compile("|".join(regexes))
+
+    def accept(self, relPath, isDir):
+        if self.exclude != None and self.exclude.search(relPath):
+            return False
+        if self.include != None and not isDir and not self.include.search(relPath):
+            return False
+        return True
+
+    def acceptPath(self, relPath, isDir):
+        """ Also check all parent directories. Used for paths not reached by walking the tree """
+        parent = os.path.dirname(relPath)
+        while parent != "":
+            if not self.accept(parent, True):
+                return False
+            parent = os.path.dirname(parent)
+        return self.accept(relPath, isDir)
+
+
+def buildLocalTree(rroot, concurrency, manifestPath, pathFilter):
+    """ If manifestPath is not None, directories not modified since the manifest was written are not listed again.
+        pathFilter may be None """
     tree = {}
     if rroot == "/":
         tree['slashTerminated'] = False
@@ -471,31 +2538,372 @@ def buildLocalTree(rroot):
             tree['slashTerminated'] = False
         prefLen = len(rroot) + 1
     tree['rroot'] = rroot
-    fileMap = {}
+    fileMap = FileTable()
     dirMap = {}
-    for root, dirs, files in os.walk(rroot, topdown=True, onerror=None, followlinks=False):
-        for fileName in files:
-            key = os.path.join(root, fileName)[prefLen:]
-            path = os.path.join(rroot, key)
-            stat = os.stat(path)
-            f = {}
-            f['size'] = stat.st_size
-            f['modificationTime'] = int(stat.st_mtime)
-            f['mode'] = "0" + oct(stat.st_mode)[-3:]
-            fileMap[key] = f
-        for dirName in dirs:
-            key = os.path.join(root, dirName)[prefLen:]
-            path = os.path.join(rroot, key)
-            stat = os.stat(path)
-            f = {}
-            f['mode'] = "0" + oct(stat.st_mode)[-3:]
-            dirMap[key] = f
+    tree['scanStart'] = time.time()
+    tree['dirTimes'] = {}
+    tree['symlinks'] = set()
+    tree['reusedDirs'] = []
+    # Directories which could not be listed, and entries which could not be stat'ed (relative paths)
+    tree['unreadable'] = set()
+    # Checksums found in the manifest, by file
+    tree['checksums'] = {}
+    tree['filterSignature'] = pathFilter.signature if pathFilter != None else ""
+    manifest = LocalManifest(manifestPath, rroot, tree['filterSignature']) if manifestPath != None else None
+    walkLocal(rroot, dirMap, fileMap, prefLen, concurrency, manifest, tree, pathFilter)
     tree['files'] = fileMap
     tree['directories'] = dirMap
     return tree
     
+
+def listLocalDir(path, accept = None, skipped = None):
+    """ Return a list of (name, isDir, isLink, stat). stat follows symlinks, as os.stat() does.
+        With scandir, entry type comes from the directory itself, so each entry is stat'ed only once, and entries rejected
+        by accept(name, isDir) are not stat'ed at all.
+        Raise OSError if the directory can't be listed. Entries which can't be stat'ed (i.e. dangling symlinks) are left aside,
+        and their names appended to skipped, if not None """
+    result = []
+    if HAS_SCANDIR:
+        for entry in scandir(path):
+            try:
+                isDir = entry.is_dir()
+                if accept == None or accept(entry.name, isDir):
+                    result.append((entry.name, isDir, entry.is_symlink(), entry.stat()))
+            except OSError:
+                if skipped != None:
+                    skipped.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            entryPath = os.path.join(path, name)
+            try:
+                lstat = os.lstat(entryPath)
+                isLink = stat.S_ISLNK(lstat.st_mode)
+                st = os.stat(entryPath) if isLink else lstat
+            except OSError:
+                if skipped != None:
+                    skipped.append(name)
+                continue
+            if accept == None or accept(name, stat.S_ISDIR(st.st_mode)):
+                result.append((name, stat.S_ISDIR(st.st_mode), isLink, st))
+    return result
+
+
+def walkLocal(rroot, dirMap, fileMap, prefLen, concurrency, manifest, tree, pathFilter):
+    """ Same result as os.walk(): Symlinks to directories are reported, but not followed. Unreadable directories are skipped.
+        Entries which can't be stat'ed (i.e. dangling symlinks) are skipped too.
+        With a manifest, modification time of each directory is recorded in tree['dirTimes'] """
+    lock = threading.Lock()
+    
+    def listDir(current):
+        key = current[prefLen:]
+        known = None
+        try:
+            if manifest != None:
+                dirStat = os.stat(current)
+                with lock:
+                    tree['dirTimes'][key] = dirStat.st_mtime
+                    if key != "":
+                        dirMap[key]['mode'] = "0" + oct(int(dirStat.st_mode))[-3:]
+                known = manifest.lookupDir(key)
+                if known != None and known[0] == dirStat.st_mtime:
+                    return reuseDir(current, known[1])
+            skipped = []
+            if pathFilter != None:
+                entries = listLocalDir(current, lambda name, isDir: pathFilter.accept(os.path.join(key, name), isDir), skipped)
+            else:
+                entries = listLocalDir(current, None, skipped)
+        except OSError:
+            with lock:
+                tree['unreadable'].add(key)
+                if key in tree['dirTimes']:
+                    # Stat'ed, but not listed. Must not be taken from the manifest as an empty directory on next run
+                    tree['dirTimes'][key] = -1
+            return []
+        if skipped:
+            with lock:
+                tree['unreadable'].update(os.path.join(key, name) for name in skipped)
+                if manifest != None:
+                    # Skipped entries may be readable on next run, while directory is unchanged. So it must be listed again
+                    tree['dirTimes'][key] = -1
+        subDirs = []
+        files = {}
+        checksums = {}
+        dirs = {}
+        links = []
+        for (name, isDir, isLink, st) in entries:
+            path = os.path.join(current, name)
+            # scandir package (python 2) reports st_mode as long
+            if isDir:
+                dirs[path[prefLen:]] = { 'mode': "0" + oct(int(st.st_mode))[-3:] }
+                if isLink:
+                    links.append(path[prefLen:])
+                else:
+                    subDirs.append(path)
+            else:
+                f = {}
+                f['size'] = st.st_size
+                f['modificationTime'] = int(st.st_mtime)
+                f['mode'] = "0" + oct(int(st.st_mode))[-3:]
+                if known != None:
+                    # Checksum is still valid if the file was not modified
+                    previous = known[1].get(name)
+                    if previous != None and previous[0] == "F" and previous[4] != "-" and int(previous[2]) == f['size'] and int(previous[3]) == f['modificationTime']:
+                        checksums[path[prefLen:]] = tuple(previous[4].split("=", 1))
+                files[path[prefLen:]] = f
+        with lock:
+            fileMap.update(files)
+            tree['checksums'].update(checksums)
+            dirMap.update(dirs)
+            tree['symlinks'].update(links)
+        return subDirs
     
-def buildHdfsTree(webHdfs, rroot):
+    def reuseDir(current, entries):
+        """ Directory content did not change. Take it from the manifest. Sub-directories still need to be checked """
+        subDirs = []
+        files = {}
+        checksums = {}
+        dirs = {}
+        links = []
+        for (name, fields) in entries.iteritems():
+            path = os.path.join(current, name)
+            if pathFilter != None and not pathFilter.accept(path[prefLen:], fields[0] != "F"):
+                continue
+            if fields[0] == "F":
+                f = {}
+                f['size'] = int(fields[2])
+                f['modificationTime'] = int(fields[3])
+                f['mode'] = fields[1]
+                if fields[4] != "-":
+                    checksums[path[prefLen:]] = tuple(fields[4].split("=", 1))
+                files[path[prefLen:]] = f
+            else:
+                dirs[path[prefLen:]] = { 'mode': fields[1] }
+                if fields[0] == "L":
+                    links.append(path[prefLen:])
+                else:
+                    subDirs.append(path)
+        with lock:
+            fileMap.update(files)
+            tree['checksums'].update(checksums)
+            dirMap.update(dirs)
+            tree['symlinks'].update(links)
+            tree['reusedDirs'].append(current)
+        return subDirs
+    
+    walkInParallel(rroot, listDir, concurrency, "local")
+    
+
+# Directories modified less than this number of seconds before the scan may be modified again without their modification
+# time changing (timestamp granularity). They are recorded as unknown, to be listed again on next run
+MANIFEST_RACY_WINDOW = 2
+
+MANIFEST_HEADER = "#hdfs_put manifest 1\t{0}\t{1}\n"
+
+class LocalManifest:
+    """ Local tree, as of last successful run. One line per entry: directory, name, type and type specific fields, tab separated.
+        Directory and name are url-quoted, so lines sorted as strings are sorted by directory first. Thus, the content of a directory is contiguous
+        and found by a binary search on the memory mapped file, without loading the whole manifest.
+        Types are: M (modification time of the directory itself, with an empty name), D (directory mode), L (symlink to a directory, mode)
+        and F (file mode, size, modificationTime, checksum) """
+    
+    def __init__(self, path, rroot, filterSignature):
+        self.data = None
+        if not os.path.isfile(path):
+            return
+        f = open(path, "rb")
+        try:
+            header = f.readline()
+            # Manifest of another source, filter or format, is ignored
+            if header == MANIFEST_HEADER.format(urllib.quote(rroot), urllib.quote(filterSignature)) and os.fstat(f.fileno()).st_size > len(header):
+                self.start = len(header)
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+    def lookupDir(self, dirKey):
+        """ Return (modificationTime, {name: [type, fields...]}), or None if directory is unknown """
+        if self.data == None:
+            return None
+        data = self.data
+        target = urllib.quote(dirKey) + "\t"
+        # Lookup the first line not lower than target. 'lo' is always a line start
+        lo = self.start
+        hi = len(data)
+        while lo < hi:
+            mid = (lo + hi) / 2
+            lineStart = data.rfind("\n", lo, mid) + 1
+            if lineStart == 0:
+                lineStart = lo
+            lineEnd = data.find("\n", lineStart)
+            if data[lineStart:lineEnd] < target:
+                lo = lineEnd + 1
+            else:
+                hi = lineStart
+        modificationTime = None
+        entries = {}
+        while lo < len(data):
+            lineEnd = data.find("\n", lo)
+            line = data[lo:lineEnd]
+            if not line.startswith(target):
+                break
+            fields = line.split("\t")
+            if fields[2] == "M":
+                modificationTime = float(fields[3])
+            else:
+                entries[urllib.unquote(fields[1])] = fields[2:]
+            lo = lineEnd + 1
+        if modificationTime == None:
+            return None
+        return (modificationTime, entries)
+
+
+def writeLocalManifest(path, tree, checksumCache):
+    lines = []
+    for (key, modificationTime) in tree['dirTimes'].iteritems():
+        if modificationTime >= tree['scanStart'] - MANIFEST_RACY_WINDOW:
+            modificationTime = -1
+        lines.append("\t".join((urllib.quote(key), "", "M", repr(modificationTime))))
+    for (key, d) in tree['directories'].iteritems():
+        lines.append("\t".join((urllib.quote(os.path.dirname(key)), urllib.quote(os.path.basename(key)), "L" if key in tree['symlinks'] else "D", d['mode'])))
+    for (key, f) in tree['files'].iteritems():
+        checksum = checksumCache.get(os.path.join(tree['rroot'], key))
+        lines.append("\t".join((urllib.quote(os.path.dirname(key)), urllib.quote(os.path.basename(key)), "F", f['mode'], str(f['size']), str(f['modificationTime']),
+                                "-" if checksum == None else "=".join(checksum))))
+    lines.sort()
+    tmpPath = path + ".tmp"
+    f = open(tmpPath, "wb")
+    try:
+        f.write(MANIFEST_HEADER.format(urllib.quote(tree['rroot']), urllib.quote(tree['filterSignature'])))
+        for line in lines:
+            f.write(line)
+            f.write("\n")
+    finally:
+        f.close()
+    os.rename(tmpPath, path)
+
+
+JOURNAL_HEADER = "#hdfs_put journal 1\t{0}\n"
+# Written records are flushed to disk at most every JOURNAL_SYNC_INTERVAL seconds, and when the journal is closed
+JOURNAL_SYNC_INTERVAL = 1.0
+
+class RunJournal:
+    """ Directories completely mirrored by a run which did not complete. One line per directory: directory, files (name:size:modificationTime)
+        as of the local scan and sub-directories (name:group on HDFS), url-quoted and tab/comma separated. Lines are only appended. A truncated last line is ignored.
+        The journal is only valid for the same source, target and parameters (signature). It is removed once a run is successful """
+    def __init__(self, path, signature):
+        self.path = path
+        self.completed = {}
+        self.lock = threading.Lock()
+        header = JOURNAL_HEADER.format(urllib.quote(signature))
+        valid = False
+        if os.path.isfile(path):
+            f = open(path, "rb")
+            try:
+                valid = f.readline() == header
+                if valid:
+                    for line in f:
+                        if not line.endswith("\n"):
+                            break
+                        (dirKey, files, subDirs) = line[:-1].split("\t")[1:]
+                        entries = {}
+                        for x in files.split(",") if files else []:
+                            (name, size, modificationTime) = x.split(":")
+                            entries[urllib.unquote(name)] = (int(size), int(modificationTime))
+                        dirs = {}
+                        for x in subDirs.split(",") if subDirs else []:
+                            (name, group) = x.split(":")
+                            dirs[urllib.unquote(name)] = urllib.unquote(group) if group else None
+                        self.completed[urllib.unquote(dirKey)] = (entries, dirs)
+            finally:
+                f.close()
+        if valid:
+            self.out = open(path, "ab")
+        else:
+            self.out = open(path, "wb")
+            self.out.write(header)
+        self.lastSync = 0
+        self.recorded = 0
+
+    def trustedDirs(self, srcTree, subDirsByDir, p):
+        """ Directories completed by the previous run, whose local files and sub-directories did not change since. They are assumed
+            to be mirrored, and are not listed again. Return, by directory, the target entries to assume: {name: status} and sub-directories """
+        trusted = {}
+        files = srcTree['files']
+        for (dirKey, (entries, subDirs)) in self.completed.iteritems():
+            if dirKey != "" and dirKey not in srcTree['directories']:
+                continue
+            if subDirsByDir.get(dirKey, set()) != set(subDirs):
+                continue
+            r = files.dirRange(dirKey)
+            (first, last) = r if r != None else (0, 0)
+            if last - first != len(entries):
+                continue
+            statuses = {}
+            for i in xrange(first, last):
+                if entries.get(files.names[i]) != (files.sizes[i], files.mtimes[i]):
+                    break
+                statuses[files.names[i]] = { 'size': files.sizes[i], 'modificationTime': files.mtimes[i], 'mode': p.mode, 'owner': p.owner, 'group': p.group }
+            else:
+                # As set by a successful run
+                trusted[dirKey] = (statuses, dict((d, { 'mode': p.directoryMode, 'owner': p.owner, 'group': group }) for (d, group) in subDirs.iteritems()))
+        return trusted
+
+    def record(self, dirKey, srcTree, subDirs, groups):
+        """ groups: group of each sub-directory """
+        files = srcTree['files']
+        r = files.dirRange(dirKey)
+        (first, last) = r if r != None else (0, 0)
+        line = "D\t{0}\t{1}\t{2}\n".format(urllib.quote(dirKey), ",".join("{0}:{1}:{2}".format(urllib.quote(files.names[i]), files.sizes[i], files.mtimes[i]) for i in xrange(first, last)),
+                                           ",".join("{0}:{1}".format(urllib.quote(d), urllib.quote(groups.get(d) or "")) for d in sorted(subDirs)))
+        with self.lock:
+            self.out.write(line)
+            self.recorded += 1
+            if time.time() - self.lastSync >= JOURNAL_SYNC_INTERVAL:
+                self.sync()
+
+    def sync(self):
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        self.lastSync = time.time()
+
+    def trackCompletion(self, srcTree, subDirsByDir, destRoot, groups, adjustments, copies):
+        """ Directories without pending adjustment or copy of their entries are recorded now. Others once the last one is successful, so a directory
+            whose tasks failed or were skipped (deadline) is never recorded. Return (adjustments, copies) to run instead of the given ones.
+            groups: group of each target directory, as returned by planMirroring(). Adjustments are keyed by HDFS path, copies by relative path """
+        rootPrefix = destRoot.rstrip("/") + "/"
+        def getDirKey(key, absolute):
+            if absolute:
+                # Adjustment of the target root itself (or of hdfs_dest, its parent) is accounted to the root
+                key = key[len(rootPrefix):] if key.startswith(rootPrefix) else ""
+            return os.path.dirname(key)
+        pending = {}
+        for (tasks, absolute) in ((adjustments, True), (copies, False)):
+            for (key, func, args) in tasks:
+                dirKey = getDirKey(key, absolute)
+                pending[dirKey] = pending.get(dirKey, 0) + 1
+        def record(dirKey):
+            subDirs = subDirsByDir.get(dirKey, ())
+            self.record(dirKey, srcTree, subDirs, dict((d, groups.get(os.path.join(destRoot, dirKey, d))) for d in subDirs))
+        for dirKey in [ "" ] + sorted(srcTree['directories']):
+            if dirKey not in pending:
+                record(dirKey)
+        lock = threading.Lock()
+        def runAndRecord(dirKey, func, args):
+            func(*args)
+            with lock:
+                pending[dirKey] -= 1
+                done = pending[dirKey] == 0
+            if done:
+                record(dirKey)
+        return ([ (key, runAndRecord, (getDirKey(key, True), func, args)) for (key, func, args) in adjustments ],
+                [ (key, runAndRecord, (getDirKey(key, False), func, args)) for (key, func, args) in copies ])
+
+    def close(self):
+        self.sync()
+        self.out.close()
+
+
+def buildHdfsTree(webHdfs, rroot, concurrency, pathFilter, trusted = None):
     tree = {}
     if rroot == "/":
         tree['slashTerminated'] = False
@@ -508,40 +2916,111 @@ def buildHdfsTree(webHdfs, rroot):
             tree['slashTerminated'] = False
         prefLen = len(rroot) + 1
     tree['rroot'] = rroot
-    fileMap = {}
+    fileMap = FileTable()
     dirMap = {}
     noAccess = []
-    walkInHdfs(webHdfs, rroot, dirMap, fileMap, noAccess, prefLen)
+    filtered = set()
+    walkInHdfs(webHdfs, rroot, dirMap, fileMap, noAccess, filtered, prefLen, concurrency, pathFilter, trusted)
     tree['files'] = fileMap
     tree['directories'] = dirMap
     tree['noAccess'] = noAccess
+    tree['filtered'] = filtered
     return tree
 
-def walkInHdfs(webHdfs, current, dirMap, fileMap, noAccess, prefLen):
-    dirContent = webHdfs.getDirContent(current)
-    #print misc.pprint2s(dirContent)
-    if dirContent['status'] == "OK":
-        for f in dirContent['files']:
-            path = os.path.join(current, f['name'])[prefLen:]
-            del f['name']
-            fileMap[path] = f
-        for d in dirContent['directories']:
-            #print misc.pprint2s(d)
-            path = os.path.join(current, d['name'])
-            del d['name']
-            dirMap[path[prefLen:]] = d
-            walkInHdfs(webHdfs, path, dirMap, fileMap, noAccess, prefLen)
-    elif dirContent['status'] == "NO_ACCESS":
-        noAccess.append(current)
-    else:
-        error("Invalid DirContent status: {0} for path:'{1}'".format(dirContent.status, current)) 
+def walkInHdfs(webHdfs, rroot, dirMap, fileMap, noAccess, filtered, prefLen, concurrency, pathFilter, trusted = None):
+    """ filtered: directories (relative paths) with some entries rejected by pathFilter.
+        trusted: content to assume for some directories, which are then not listed (See RunJournal) """
+    lock = threading.Lock()
+    
+    def listDir(current):
+        subDirs = []
+        if webHdfs.deadline != None and not webHdfs.deadline.admitListing(current):
+            return subDirs
+        if trusted != None and current[prefLen:] in trusted:
+            (files, dirs) = trusted[current[prefLen:]]
+            with lock:
+                for (name, status) in files.iteritems():
+                    fileMap[os.path.join(current, name)[prefLen:]] = status
+                for (name, status) in dirs.iteritems():
+                    dirMap[os.path.join(current, name)[prefLen:]] = status
+            return [ os.path.join(current, name) for name in dirs ]
+        dirContent = webHdfs.getDirContent(current)
+        #print misc.pprint2s(dirContent)
+        if dirContent['status'] == "OK":
+            for e in dirContent['entries']:
+                path = os.path.join(current, e.pop('name'))
+                isFile = e.pop('type') == 'FILE'
+                if pathFilter != None and not pathFilter.accept(path[prefLen:], not isFile):
+                    with lock:
+                        filtered.add(current[prefLen:])
+                    continue
+                if isFile:
+                    with lock:
+                        fileMap[path[prefLen:]] = e
+                else:
+                    with lock:
+                        dirMap[path[prefLen:]] = e
+                    subDirs.append(path)
+        elif dirContent['status'] == "NO_ACCESS":
+            with lock:
+                noAccess.append(current)
+        else:
+            error("Invalid DirContent status: {0} for path:'{1}'".format(dirContent['status'], current)) 
+        return subDirs
+
+    walkInParallel(rroot, listDir, concurrency, "HDFS")
+
+
+def walkInParallel(root, listDir, concurrency, what):
+    """ Breadth-first walk. listDir(path) return the sub-directories to walk. Up to 'concurrency' of them run simultaneously """
+    pending = Queue.Queue()
+    pending.put(root)
+    lock = threading.Lock()
+    failures = []
+    
+    if concurrency <= 1:
+        while not pending.empty():
+            for subDir in listDir(pending.get()):
+                pending.put(subDir)
+        return
+    
+    def worker():
+        while True:
+            current = pending.get()
+            if current == None:
+                pending.task_done()
+                return
+            try:
+                for subDir in listDir(current):
+                    pending.put(subDir)
+            except Exception as e:
+                with lock:
+                    failures.append((current, str(e)))
+            pending.task_done()
+    
+    workers = []
+    for _ in range(concurrency):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        workers.append(t)
+    # Sub-directories are queued before their parent is marked as done, so join() returns only when the whole tree is listed
+    pending.join()
+    for t in workers:
+        pending.put(None)
+    for t in workers:
+        t.join()
+    if failures:
+        failures.sort()
+        error("Unable to list {0} {1} directories: {2}", len(failures), what, "; ".join("{0}: {1}".format(path, msg) for (path, msg) in failures))
 
 
 def buildEmptyTree(rroot):
         tree = {}
-        tree['files'] = {}
+        tree['files'] = FileTable()
         tree['directories'] = {}
         tree['noAccess'] = []
+        tree['filtered'] = set()
         if rroot == "/":
             tree['slashTerminated'] = False
         else:
@@ -552,24 +3031,186 @@ def buildEmptyTree(rroot):
                 tree['slashTerminated'] = False
         tree['rroot'] = rroot
         return tree       
-                
+
+
+# Prefix of the snapshots created (and deleted) by this module
+SNAPSHOT_PREFIX = "hdfs_put-"
+
+def buildDestTree(webHdfs, rroot, p):
+    if p.snapshotDiffCache != None and not p.checkMode:
+        return buildHdfsTreeFromSnapshot(webHdfs, rroot, p)
+    return buildHdfsTree(webHdfs, rroot, p.listingParallelism, p.pathFilter, p.journalTrusted)
+
+
+def buildHdfsTreeFromSnapshot(webHdfs, rroot, p):
+    """ Target tree is read from a local cache, recording it as of a snapshot taken on previous run. Then only paths reported by the
+        snapshot diff since then are listed again. A new snapshot is taken, and becomes the reference of the cache for next run. 
+        Fall back to a full listing if the previous snapshot or the cache is missing """
+    snapshotName = "{0}{1}".format(SNAPSHOT_PREFIX, int(time.time() * 1000))
+    if not webHdfs.createSnapshot(rroot, snapshotName):
+        p.snapshotDiffStats = { 'listing': "full", 'reason': "{0} is not snapshottable".format(rroot) }
+        return buildHdfsTree(webHdfs, rroot, p.listingParallelism, p.pathFilter)
+    filterSignature = p.pathFilter.signature if p.pathFilter != None else ""
+    tree = loadHdfsTreeCache(p.snapshotDiffCache, rroot, filterSignature)
+    diff = None
+    if tree != None:
+        diff = webHdfs.getSnapshotDiff(tree['rroot'], tree['snapshot'], snapshotName)
+    if diff == None:
+        p.snapshotDiffStats = { 'listing': "full", 'reason': "No cache" if tree == None else "Snapshot {0} not found".format(tree['snapshot']) }
+        tree = buildHdfsTree(webHdfs, rroot, p.listingParallelism, p.pathFilter)
+    else:
+        p.snapshotDiffStats = { 'listing': "diff", 'from': tree['snapshot'], 'changes': len(diff) }
+        applySnapshotDiff(webHdfs, tree, diff, p.listingParallelism, p.pathFilter)
+        tree['files'] = FileTable(tree['files'])
+    p.snapshotDiffStats['snapshot'] = snapshotName
+    # Tree is the one of the new snapshot, whatever happen later on
+    writeHdfsTreeCache(p.snapshotDiffCache, tree, snapshotName, filterSignature)
+    # Previous references, including the ones left by a run whose cache was lost, would keep deleted blocks forever
+    for x in webHdfs.listSnapshots(rroot):
+        if x.startswith(SNAPSHOT_PREFIX) and not x.startswith(BACKUP_SNAPSHOT_PREFIX) and x != snapshotName:
+            webHdfs.deleteSnapshot(rroot, x)
+    return tree
+
+
+def loadHdfsTreeCache(path, rroot, filterSignature):
+    if not os.path.isfile(path):
+        return None
+    f = open(path, "rb")
+    try:
+        cache = json.load(f)
+    finally:
+        f.close()
+    tree = buildEmptyTree(rroot)
+    if cache.get('rroot') != tree['rroot'] or cache.get('filter', "") != filterSignature:
+        return None
+    tree['snapshot'] = cache['snapshot']
+    tree['files'] = cache['files']
+    tree['directories'] = cache['directories']
+    tree['noAccess'] = cache['noAccess']
+    tree['filtered'] = set(cache.get('filtered', []))
+    return tree
+
+
+def writeHdfsTreeCache(path, tree, snapshotName, filterSignature):
+    tmpPath = path + ".tmp"
+    f = open(tmpPath, "wb")
+    try:
+        json.dump({ 'rroot': tree['rroot'], 'snapshot': snapshotName, 'files': dict(tree['files'].iteritems()), 'directories': tree['directories'], 'noAccess': tree['noAccess'], 'filtered': sorted(tree['filtered']), 'filter': filterSignature }, f)
+    finally:
+        f.close()
+    os.rename(tmpPath, path)
+
+
+def applySnapshotDiff(webHdfs, tree, diff, concurrency, pathFilter):
+    """ diff entries are relative to the snapshot root. A created or deleted directory is reported alone, not with its content """
+    rroot = tree['rroot']
+    prefLen = len(rroot) if rroot == "/" else len(rroot) + 1
+    dropped = set()
+    created = set()
+    modified = set()
+    for d in diff:
+        sourcePath = d['sourcePath']
+        if sourcePath == "" or sourcePath == ".":
+            # Target root itself
+            continue
+        if d['type'] == "DELETE":
+            dropped.add(sourcePath)
+        elif d['type'] == "RENAME":
+            dropped.add(sourcePath)
+            created.add(d['targetPath'])
+        elif d['type'] == "CREATE":
+            created.add(sourcePath)
+        else:
+            modified.add(sourcePath)
+    # Created paths are listed again from scratch. So, remove their previous content, if any
+    dropped.update(created)
+    for m in (tree['files'], tree['directories']) if dropped else ():
+        for key in m.keys():
+            path = key
+            while path != "":
+                if path in dropped:
+                    del m[key]
+                    break
+                path = os.path.dirname(path)
+
+    def refresh(key, walk):
+        (pathType, status) = webHdfs.getPathTypeAndStatus(os.path.join(rroot, key))
+        tree['files'].pop(key, None)
+        tree['directories'].pop(key, None)
+        if pathFilter != None and not pathFilter.acceptPath(key, pathType == "DIRECTORY"):
+            tree['filtered'].add(os.path.dirname(key))
+            return
+        if pathType == "FILE":
+            tree['files'][key] = status
+        elif pathType == "DIRECTORY":
+            tree['directories'][key] = { 'mode': status['mode'], 'owner': status['owner'], 'group': status['group'] }
+            if walk:
+                walkInHdfs(webHdfs, os.path.join(rroot, key), tree['directories'], tree['files'], tree['noAccess'], tree['filtered'], prefLen, concurrency, pathFilter)
+        # NOT_FOUND: Removed after the new snapshot. NO_ACCESS: Unchanged, as for a full listing
+    
+    tasks = [ (key, refresh, (key, True)) for key in sorted(created) ]
+    tasks.extend([ (key, refresh, (key, False)) for key in sorted(modified - created) ])
+    failOnErrors(runTasks(tasks, concurrency), "HDFS path(s) could not be listed again")
+
+
 def main():
     
     global module
     module = AnsibleModule(
         argument_spec = dict(
+            adaptive_concurrency = dict(required=False, type='bool', default=False),
+            append_detection = dict(required=False, choices=[AppendDetection.NO, AppendDetection.CHECKSUM, AppendDetection.SAMPLE], default=AppendDetection.NO),
             backup = dict(required=False, type='bool', default=False),
+            backup_mode = dict(required=False, choices=[BackupMode.RENAME, BackupMode.SNAPSHOT], default=BackupMode.RENAME),
+            backup_snapshots = dict(required=False, type='int', default=None),
+            checksum_processes = dict(required=False, type='int', default=None),
+            compare = dict(required=False, choices=[Compare.SIZE_MTIME, Compare.CHECKSUM], default=Compare.SIZE_MTIME),
+            connect_timeout = dict(required=False, type='int', default=10),
+            data_connect_timeout = dict(required=False, type='int', default=None),
+            data_read_timeout = dict(required=False, type='int', default=300),
+            deadline = dict(required=False, type='int', default=None),
+            delete_extraneous = dict(required=False, type='bool', default=False),
             directory_mode = dict(required=False, default=None),
             force = dict(required=False, type='bool', default=True),
             force_ext = dict(required=False, type='bool', default=True),
             group = dict(required=False, default=None),
             hadoop_conf_dir = dict(required=False, default="/etc/hadoop/conf"),
             hdfs_dest  = dict(required=True),
+            exclude = dict(required=False, type='list', default=None),
+            include = dict(required=False, type='list', default=None),
+            hdfs_bytes_per_checksum = dict(required=False, type='int', default=512),
+            hdfs_checksum_type = dict(required=False, choices=['CRC32C', 'CRC32'], default='CRC32C'),
+            hdfs_umask = dict(required=False, type='raw', default="022"),
             hdfs_user = dict(required=False, default="hdfs"),
+            http_pool_connections = dict(required=False, type='int', default=10),
+            http_pool_maxsize = dict(required=False, type='int', default=10),
+            journal = dict(required=False, default=None),
+            listing_parallelism = dict(required=False, type='int', default=1),
+            local_manifest = dict(required=False, default=None),
+            local_scan_parallelism = dict(required=False, type='int', default=1),
+            max_bandwidth = dict(required=False, type='int', default=None),
+            max_concurrency = dict(required=False, type='int', default=None),
+            max_deletes = dict(required=False, type='int', default=1000),
+            max_ops_per_sec = dict(required=False, type='int', default=None),
+            max_retries = dict(required=False, type='int', default=5),
+            metadata_window = dict(required=False, type='int', default=1),
+            min_concurrency = dict(required=False, type='int', default=1),
             mode = dict(required=False, default=None),
+            multipart_parallelism = dict(required=False, type='int', default=4),
+            multipart_part_size = dict(required=False, type='int', default=268435456),
+            multipart_threshold = dict(required=False, type='int', default=None),
             owner = dict(required=False, default=None),
+            parallelism = dict(required=False, type='int', default=1),
+            pipelined = dict(required=False, type='bool', default=False),
+            read_timeout = dict(required=False, type='int', default=60),
+            retry_delay = dict(required=False, type='int', default=1000),
+            snapshot_diff_cache = dict(required=False, default=None),
             src  = dict(required=True, default=None),
+            target_latency = dict(required=False, type='int', default=1000),
+            use_regex = dict(required=False, type='bool', default=False),
+            verify = dict(required=False, type='bool', default=False),
             webhdfs_endpoint = dict(required=False, default=None),
+            zero_copy = dict(required=False, type='bool', default=True),
         ),
         supports_check_mode=True
     )
@@ -578,26 +3219,97 @@ def main():
         module.fail_json(msg="python-requests package is not installed")    
 
     p = Parameters()
+    p.adaptiveConcurrency = module.params['adaptive_concurrency']
+    p.appendDetection = module.params['append_detection']
     p.backup = module.params['backup']
+    p.backupMode = module.params['backup_mode']
+    p.backupSnapshots = module.params['backup_snapshots']
+    p.checksumProcesses = module.params['checksum_processes']
+    p.compare = module.params['compare']
+    p.connectTimeout = module.params['connect_timeout']
+    p.dataConnectTimeout = module.params['data_connect_timeout']
+    p.dataReadTimeout = module.params['data_read_timeout']
+    p.deadline = module.params['deadline']
+    p.deleteExtraneous = module.params['delete_extraneous']
     p.directoryMode = module.params['directory_mode']
     p.force = module.params['force']
     p.forceExt = module.params['force_ext']
     p.group = module.params['group']
     p.hadoopConfDir = module.params['hadoop_conf_dir']
     p.hdfsDest = module.params['hdfs_dest']
+    p.exclude = module.params['exclude']
+    p.include = module.params['include']
+    p.hdfsBytesPerChecksum = module.params['hdfs_bytes_per_checksum']
+    p.hdfsChecksumType = module.params['hdfs_checksum_type']
+    p.hdfsUmask = module.params['hdfs_umask']
     p.hdfsUser = module.params['hdfs_user']
+    p.httpPoolConnections = module.params['http_pool_connections']
+    p.httpPoolMaxsize = module.params['http_pool_maxsize']
+    p.journal = module.params['journal']
+    p.listingParallelism = module.params['listing_parallelism']
+    p.localManifest = module.params['local_manifest']
+    p.localScanParallelism = module.params['local_scan_parallelism']
+    p.maxBandwidth = module.params['max_bandwidth']
+    p.maxConcurrency = module.params['max_concurrency']
+    p.maxDeletes = module.params['max_deletes']
+    p.maxOpsPerSec = module.params['max_ops_per_sec']
+    p.maxRetries = module.params['max_retries']
+    p.metadataWindow = module.params['metadata_window']
+    p.minConcurrency = module.params['min_concurrency']
     p.mode = module.params['mode']
+    p.multipartParallelism = module.params['multipart_parallelism']
+    p.multipartPartSize = module.params['multipart_part_size']
+    p.multipartThreshold = module.params['multipart_threshold']
     p.owner = module.params['owner']
+    p.parallelism = module.params['parallelism']
+    p.pipelined = module.params['pipelined']
+    p.readTimeout = module.params['read_timeout']
+    p.retryDelay = module.params['retry_delay']
+    p.snapshotDiffCache = module.params['snapshot_diff_cache']
     p.src = module.params['src']
+    p.targetLatency = module.params['target_latency']
+    p.useRegex = module.params['use_regex']
+    p.verify = module.params['verify']
     p.webhdfsEndpoint = module.params['webhdfs_endpoint']
+    p.zeroCopy = module.params['zero_copy']
 
     p.checkMode = module.check_mode
     p.changed = False
+    p.rpcPlanned = 0
+    p.rpcNaive = 0
+    p.appendedFiles = 0
+    p.appendSavedBytes = 0
+    p.multipartStats = MultipartStats()
+    # Local checksums, by source path: (signature, value)
+    p.checksumCache = {}
+    p.localScanStats = None
+    p.snapshotDiffStats = None
+    p.pipelineStats = None
+    p.treeStats = None
+    p.deletedStats = None
+    p.backupNeeded = False
+    p.journalTrusted = None
+    p.journalStats = None
+    p.backupSnapshot = None
+    p.diffSeconds = 0.0
+    # Serialize planning (and its counters) when directories are compared by several threads
+    p.planLock = threading.Lock()
+    p.startTime = time.time()
 
     checkParameters(p)
     
     global webHDFS
     webHDFS = lookupWebHdfs(p)
+    webHDFS.zeroCopy = p.zeroCopy and HAS_SENDFILE
+    webHDFS.maxRetries = p.maxRetries
+    webHDFS.deadline = p.deadline
+    webHDFS.retryDelay = p.retryDelay / 1000.0
+    if p.adaptiveConcurrency:
+        webHDFS.concurrency = AdaptiveConcurrency(p.minConcurrency, p.maxConcurrency, p.targetLatency / 1000.0)
+    if p.maxBandwidth != None:
+        webHDFS.bandwidth = TokenBucket(p.maxBandwidth)
+    if p.maxOpsPerSec != None:
+        webHDFS.namenodeRate = TokenBucket(p.maxOpsPerSec)
     
     (destPathType,  destStatus) = webHDFS.getPathTypeAndStatus(p.hdfsDest)
     
@@ -613,31 +3325,45 @@ def main():
         if destPathType == "NOT_FOUND":  # -------------------------------------------------------- Target does not exist
             # hdfs_dest does not exist. Ensure base dir exists
             destBasedir = os.path.dirname(p.hdfsDest)
-            (destBaseDirType, _) = webHDFS.getPathTypeAndStatus(destBasedir)
+            (destBaseDirType, destBaseDirStatus) = webHDFS.getPathTypeAndStatus(destBasedir)
             if destBaseDirType != 'DIRECTORY':
                 error("Destination directory {0} does not exist", destBasedir)
             p.changed = True
+            ops = planNewFile(p.src, p.hdfsDest, int(os.stat(p.src).st_mtime), False, False, destBaseDirStatus['group'], p)
             if not p.checkMode:
-                webHDFS.putFileToHdfs(p.src, p.hdfsDest, False)
-                webHDFS.setModificationTime(p.hdfsDest, int(os.stat(p.src).st_mtime))
-                applyAttrOnNewFile(webHDFS, p.hdfsDest, p)
+                executeOps(webHDFS, ops)
         elif destPathType == 'FILE':  # --------------------------------------------- Target already exists. Check if we need to overwrite.
             stat = os.stat(p.src)
-            if p.force and (stat.st_size != destStatus['size'] or  int(stat.st_mtime) != destStatus['modificationTime']):
+            if (p.force and p.compare == Compare.CHECKSUM and stat.st_size == destStatus['size'] and stat.st_size > 0 and int(stat.st_mtime) != destStatus['modificationTime']
+                    and findIdenticalFiles(webHDFS, [(p.src, p.src, p.hdfsDest, destStatus['blockSize'], destStatus['size'])], p)):
+                # Same content. Only modification time differ
+                p.changed = True
+                ops = planTouchFile(p.hdfsDest, int(stat.st_mtime), destStatus, p)
+                if not p.checkMode:
+                    executeOps(webHDFS, ops)
+            elif (isAppendCandidate(stat.st_size, destStatus['size'], p)
+                    and findAppendableFiles(webHDFS, [(p.src, p.src, p.hdfsDest, destStatus['blockSize'], destStatus['size'])], p)):
+                p.changed = True
+                ops = planAppendFile(p.src, p.hdfsDest, int(stat.st_mtime), stat.st_size, destStatus, p)
+                if not p.checkMode:
+                    if p.backupNeeded:
+                        takeBackupSnapshot(webHDFS, os.path.dirname(p.hdfsDest), p)
+                    executeOps(webHDFS, ops)
+            elif p.force and (stat.st_size != destStatus['size'] or  int(stat.st_mtime) != destStatus['modificationTime']):
                 #print("{{ statst_size: {0}, destStatus_length: {1}, int_stat_st_mtime: {2}, estStatus_modificationTime_1000: {3} }}".format(stat.st_size, destStatus['length'], int(stat.st_mtime), destStatus['modificationTime']/100))
                 # File changed. Must be copied again
                 p.changed = True
+                ops = planNewFile(p.src, p.hdfsDest, int(stat.st_mtime), True, p.backup, None, p)
                 if not p.checkMode:
-                    if p.backup:
-                        backupHdfsFile(webHDFS, p.hdfsDest)
-                    webHDFS.putFileToHdfs(p.src, p.hdfsDest, True)
-                    webHDFS.setModificationTime(p.hdfsDest, int(stat.st_mtime))
-                    applyAttrOnNewFile(webHDFS, p.hdfsDest, p)
+                    if p.backupNeeded:
+                        takeBackupSnapshot(webHDFS, os.path.dirname(p.hdfsDest), p)
+                    executeOps(webHDFS, ops)
             else:
                 if checkAttrOnExistingFile(destStatus, p) and p.forceExt:
                     p.changed = True
+                    ops = planAdjustFile(p.hdfsDest, destStatus, p)
                     if not p.checkMode:
-                        adjustAttrOnExistingFile(webHDFS, p.hdfsDest, destStatus, p)
+                        executeOps(webHDFS, ops)
         elif destPathType == 'DIRECTORY':
             error("hdfs_dest '{0}' is a directory. Must be a file or not existing", p.hdfsDest)
         else:
@@ -653,42 +3379,248 @@ def main():
         elif destPathType != "DIRECTORY":
             error("HDFS path {0}: Unknown type: '{1}'", p.hdfsDest, destPathType)
         
-        handlePutByMirroring(webHDFS, p)
+        handlePutByMirroring(webHDFS, p, destStatus)
 
+    stats = webHDFS.getConnectionStats()
     cleanup()
-    module.exit_json(changed=p.changed)
+    result = dict(changed=p.changed, webhdfs_stats=stats, rpc_plan={ 'planned': p.rpcPlanned, 'saved': p.rpcNaive - p.rpcPlanned },
+        appended={ 'files': p.appendedFiles, 'saved_bytes': p.appendSavedBytes },
+        multipart={ 'files': p.multipartStats.files, 'uploaded_parts': p.multipartStats.uploadedParts, 'resumed_parts': p.multipartStats.resumedParts },
+        transfers=webHDFS.getTransferStats(), local_scan=p.localScanStats, snapshot_diff=p.snapshotDiffStats,
+        pipeline=p.pipelineStats, trees=p.treeStats, deleted=p.deletedStats,
+        backup_snapshot=p.backupSnapshot, journal=p.journalStats,
+        concurrency=webHDFS.concurrency.getStats() if webHDFS.concurrency != None else None, throttling=webHDFS.getThrottlingStats(),
+        retries=webHDFS.getRetryStats(), deadline=p.deadline.getStats() if p.deadline != None else None)
+    if p.deadline != None and p.deadline.interrupted:
+        module.fail_json(msg="Deadline of {0} seconds reached: {1} task(s) not started and {2} directory(ies) not listed. Completed work is reported"
+                         .format(p.deadline.seconds, len(p.deadline.skipped), len(p.deadline.unlisted)), **result)
+    module.exit_json(**result)
 
 
 
 
 
 
-def handlePutByMirroring(webHDFS, p):    
-    srcTree = buildLocalTree(p.src)
+def handlePutByMirroring(webHDFS, p, destStatus):    
+    if p.pipelined:
+        return handlePutByPipelining(webHDFS, p, destStatus)
+    srcTree = buildLocalTree(p.src, p.localScanParallelism, p.localManifest, p.pathFilter)
+    for (fileName, checksum) in srcTree['checksums'].iteritems():
+        p.checksumCache[os.path.join(srcTree['rroot'], fileName)] = checksum
+    p.localScanStats = { 'directories': len(srcTree['dirTimes']), 'reused_directories': len(srcTree['reusedDirs']) } if p.localManifest != None else None
+    # Group of existing HDFS directories, used by the planner to take care of group inheritance
+    currentGroups = {}
 
     directoriesToCreate = []
     directoriesToAdjust = []
-    filesToCreate = []
-    filesToReplace = []
-    filesToAdjust = []
 
+    journal = None
+    if p.journal != None and not p.checkMode:
+        subDirsByDir = {}
+        for d in srcTree['directories']:
+            subDirsByDir.setdefault(os.path.dirname(d), set()).add(os.path.basename(d))
+        destRoot = p.hdfsDest if srcTree['slashTerminated'] else os.path.join(p.hdfsDest, os.path.basename(srcTree['rroot']))
+        signature = json.dumps([ srcTree['rroot'], destRoot, p.owner, p.group, p.mode, p.directoryMode, p.force, p.forceExt, srcTree['filterSignature'] ])
+        journal = RunJournal(p.journal, signature)
+        p.journalTrusted = journal.trustedDirs(srcTree, subDirsByDir, p)
+        p.journalStats = { 'trusted_directories': len(p.journalTrusted) }
+
+    destRootStatus = None
     # If source does not end with '/', its basename will be added to target path. And directory created if not existing
     if not srcTree['slashTerminated']:
         x = os.path.basename(srcTree['rroot'])
         p.hdfsDest = os.path.join(p.hdfsDest, x)
+        currentGroups[os.path.dirname(p.hdfsDest)] = destStatus['group']
         (ft, dirStatus) = webHDFS.getPathTypeAndStatus(p.hdfsDest)
         if ft == "NOT_FOUND":
             directoriesToCreate.append(p.hdfsDest)
             destTree = buildEmptyTree(p.hdfsDest)
         elif ft == "DIRECTORY":
-            destTree = buildHdfsTree(webHDFS, p.hdfsDest)
-            destTree['directories'][p.hdfsDest] = dirStatus  # Will need to to apply modification later on
+            destTree = buildDestTree(webHDFS, p.hdfsDest, p)
+            # Will need to to apply modification later on. Recorded once deletions are planned, as this is not a relative path
+            destRootStatus = dirStatus
             if checkAttrOnExistingDir(dirStatus, p):
                 directoriesToAdjust.append(p.hdfsDest)
         else:
             error("HDFS path {0}: Invalid type: '{1}'", p.hdfsDest, ft)
     else:
-        destTree = buildHdfsTree(webHDFS, p.hdfsDest)
+        destTree = buildDestTree(webHDFS, p.hdfsDest, p)
+        currentGroups[destTree['rroot']] = destStatus['group']
+    if p.deadline != None and p.deadline.reached():
+        # Trees may be incomplete. Nothing is performed
+        p.deadline.interrupted = True
+        if journal != None:
+            journal.close()
+        return
+
+    deletes = []
+    if p.deleteExtraneous:
+        (deletes, count) = planDeletes(srcTree, destTree, p)
+        if count > p.maxDeletes:
+            error("{0} entries would be deleted on HDFS, more than max_deletes ({1}). Nothing done", count, p.maxDeletes)
+        p.deletedStats = { 'paths': [ op[1] for op in deletes ], 'entries': count }
+    if destRootStatus != None:
+        destTree['directories'][p.hdfsDest] = destRootStatus
+    (adjustments, copies, groups) = planMirroring(webHDFS, srcTree, destTree, currentGroups, directoriesToCreate, directoriesToAdjust, p)
+    if deletes and p.backup and p.backupMode == BackupMode.SNAPSHOT:
+        p.backupNeeded = True
+    if p.backupNeeded and not p.checkMode:
+        takeBackupSnapshot(webHDFS, destTree['rroot'], p)
+    p.treeStats = { 'local_files': len(srcTree['files']), 'hdfs_files': len(destTree['files']), 'memory_bytes': srcTree['files'].memoryUsage() + destTree['files'].memoryUsage(),
+                    'diff_seconds': round(p.diffSeconds, 3), 'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 }
+    try:
+        if journal != None:
+            (adjustments, copies) = journal.trackCompletion(srcTree, subDirsByDir, destRoot, groups, adjustments, copies)
+        if not p.checkMode:
+            failOnErrors(runTasks(adjustments, p.metadataWindow, p.deadline), "path(s) failed to be adjusted")
+        failOnErrors(runTasks(copies, p.parallelism, p.deadline), "file(s) failed to be copied")
+    finally:
+        if journal != None:
+            journal.close()
+            p.journalStats['recorded_directories'] = journal.recorded
+    # Only once everything is copied. So a failed or interrupted run deletes nothing
+    if deletes and not (p.deadline != None and p.deadline.interrupted):
+        p.changed = True
+        if not p.checkMode:
+            failOnErrors(runTasks([ (op[1], executeOps, (webHDFS, [op])) for op in deletes ], p.metadataWindow, p.deadline), "path(s) failed to be deleted")
+    
+    if p.deadline != None and p.deadline.interrupted:
+        # Run is incomplete. The journal (if any) will allow to resume it
+        return
+    if p.localManifest != None and not p.checkMode:
+        writeLocalManifest(p.localManifest, srcTree, p.checksumCache)
+    if journal != None:
+        # Mirror is complete. Next run must compare everything again
+        os.remove(p.journal)
+
+
+def handlePutByPipelining(webHDFS, p, destStatus):
+    """ Local and HDFS trees are walked together, directory by directory. Each directory is compared as soon as both listings are available,
+        and resulting work is handed over to the workers while the walk goes on """
+    rootTree = buildEmptyTree(p.src)
+    srcRoot = rootTree['rroot']
+    srcPrefLen = len(srcRoot) + 1 if srcRoot != "/" else 1
+    # State of each target directory to compare: (existing on HDFS before this run, group). Directories created by this run are known to be empty
+    dirStates = {}
+    lock = threading.Lock()
+    backupLock = threading.Lock()
+    
+    if rootTree['slashTerminated']:
+        dirStates[srcRoot] = (True, destStatus['group'])
+    else:
+        p.hdfsDest = os.path.join(p.hdfsDest, os.path.basename(srcRoot))
+        (ft, dirStatus) = webHDFS.getPathTypeAndStatus(p.hdfsDest)
+        if ft == "NOT_FOUND":
+            p.changed = True
+            (ops, newGroups) = planNewDirectories([p.hdfsDest], { os.path.dirname(p.hdfsDest): destStatus['group'] }, p)
+            if not p.checkMode:
+                executeOps(webHDFS, ops)
+            # Just created, so empty. Not listed
+            dirStates[srcRoot] = (False, newGroups[p.hdfsDest])
+        elif ft == "DIRECTORY":
+            group = dirStatus['group']
+            if checkAttrOnExistingDir(dirStatus, p) and p.forceExt:
+                p.changed = True
+                ops = planAdjustDir(p.hdfsDest, dirStatus, p)
+                if not p.checkMode:
+                    executeOps(webHDFS, ops)
+                if p.group != None:
+                    group = p.group
+            dirStates[srcRoot] = (True, group)
+        else:
+            error("HDFS path {0}: Invalid type: '{1}'", p.hdfsDest, ft)
+    destRoot = p.hdfsDest
+    
+    metadataPool = TaskPool(p.metadataWindow, p.deadline)
+    copyPool = TaskPool(p.parallelism, p.deadline)
+    
+    def listDir(current):
+        key = current[srcPrefLen:]
+        destDir = os.path.join(destRoot, key) if key != "" else destRoot
+        with lock:
+            (destExists, group) = dirStates.pop(current)
+        if p.deadline != None and not p.deadline.admitListing(current):
+            return []
+        try:
+            if p.pathFilter != None:
+                entries = listLocalDir(current, lambda name, isDir: p.pathFilter.accept(os.path.join(key, name), isDir))
+            else:
+                entries = listLocalDir(current)
+        except OSError:
+            return []
+        srcTree = { 'rroot': srcRoot, 'files': FileTable(), 'directories': {} }
+        subDirs = []
+        for (name, isDir, isLink, st) in sorted(entries):
+            # scandir package (python 2) reports st_mode as long
+            if isDir:
+                srcTree['directories'][os.path.join(key, name)] = { 'mode': "0" + oct(int(st.st_mode))[-3:] }
+                if not isLink:
+                    subDirs.append(os.path.join(current, name))
+            else:
+                srcTree['files'][os.path.join(key, name)] = { 'size': st.st_size, 'modificationTime': int(st.st_mtime), 'mode': "0" + oct(int(st.st_mode))[-3:] }
+        destTree = { 'rroot': destRoot, 'files': FileTable(), 'directories': {} }
+        if destExists:
+            dirContent = webHDFS.getDirContent(destDir)
+            if dirContent['status'] == "OK":
+                for e in dirContent['entries']:
+                    name = os.path.join(key, e.pop('name'))
+                    isFile = e.pop('type') == 'FILE'
+                    if p.pathFilter != None and not p.pathFilter.accept(name, not isFile):
+                        continue
+                    if isFile:
+                        destTree['files'][name] = e
+                    else:
+                        destTree['directories'][name] = e
+            elif dirContent['status'] != "NO_ACCESS":
+                error("Invalid DirContent status: {0} for path:'{1}'".format(dirContent['status'], destDir))
+        # Only entries of this directory are compared. Sub-directories will be compared when listed
+        (adjustments, copies, groups) = planMirroring(webHDFS, srcTree, destTree, { destDir: group }, [], [], p)
+        if p.backupNeeded and not p.checkMode:
+            with backupLock:
+                if p.backupSnapshot == None:
+                    takeBackupSnapshot(webHDFS, destRoot, p)
+        if not p.checkMode:
+            for (k, func, args) in adjustments:
+                metadataPool.submit(k, func, args)
+        for (k, func, args) in sorted(copies):
+            copyPool.submit(k, func, args)
+        with lock:
+            for subDir in subDirs:
+                destSubDir = os.path.join(destRoot, subDir[srcPrefLen:])
+                dirStates[subDir] = (subDir[srcPrefLen:] in destTree['directories'], groups.get(destSubDir))
+            p.pipelineStats['directories'] += 1
+        return subDirs
+    
+    p.pipelineStats = { 'directories': 0, 'first_copy_after': None }
+    # Walk is run aside, so a failure does not prevent already submitted tasks from being completed before it is reported
+    walkErrors = []
+    def walk():
+        try:
+            walkInParallel(srcRoot, listDir, p.listingParallelism, "local and HDFS")
+        except Exception as e:
+            walkErrors.append(str(e))
+    walker = threading.Thread(target=walk)
+    walker.daemon = True
+    walker.start()
+    walker.join()
+    metadataFailures = metadataPool.join()
+    copyFailures = copyPool.join()
+    if copyPool.firstStart != None:
+        p.pipelineStats['first_copy_after'] = round(copyPool.firstStart - p.startTime, 3)
+    if walkErrors:
+        error("{0}", walkErrors[0])
+    failOnErrors(metadataFailures, "path(s) failed to be adjusted")
+    failOnErrors(copyFailures, "file(s) failed to be copied")
+
+
+def planMirroring(webHDFS, srcTree, destTree, currentGroups, directoriesToCreate, directoriesToAdjust, p):
+    """ Compare trees. Missing directories are created right away. Other operations are returned, as lists of tasks for runTasks():
+        (adjustments, copies, groups), where groups is the group of each target directory, once created or adjusted.
+        Trees may be limited to the content of a single directory """
+    currentGroups = dict(currentGroups)
+    filesToReplace = []
+    for dirName, dirStatus in destTree['directories'].iteritems():
+        currentGroups[os.path.join(destTree['rroot'], dirName)] = dirStatus['group']
     
     # Lookup all folder to create on target
     for dirName in srcTree['directories']:
@@ -702,63 +3634,110 @@ def handlePutByMirroring(webHDFS, p):
     directoriesToAdjust.sort()
     directoriesToCreate.sort()
 
-    for fileName in srcTree['files']:
-        if fileName in destTree['files']:
-            srcFilesStatus = srcTree['files'][fileName]
-            destFilesStatus = destTree['files'][fileName]
-            if srcFilesStatus['size'] != destFilesStatus['size'] or srcFilesStatus['modificationTime'] != destFilesStatus['modificationTime']:
-                filesToReplace.append(fileName)
-            elif checkAttrOnExistingFile(destTree['files'][fileName], p):
-                filesToAdjust.append(fileName)
+    start = time.time()
+    (filesToCreate, filesDiffering, filesToAdjust) = diffFileTables(srcTree['files'], destTree['files'], p)
+    with p.planLock:
+        p.diffSeconds += time.time() - start
+    checksumCandidates = []
+    appendCandidates = []
+    for fileName in filesDiffering:
+        srcFilesStatus = srcTree['files'][fileName]
+        destFilesStatus = destTree['files'][fileName]
+        if p.compare == Compare.CHECKSUM and p.force and srcFilesStatus['size'] == destFilesStatus['size'] and srcFilesStatus['size'] > 0:
+            checksumCandidates.append((fileName, os.path.join(srcTree['rroot'], fileName), os.path.join(destTree['rroot'], fileName), destFilesStatus['blockSize'], destFilesStatus['size']))
+        elif isAppendCandidate(srcFilesStatus['size'], destFilesStatus['size'], p):
+            appendCandidates.append((fileName, os.path.join(srcTree['rroot'], fileName), os.path.join(destTree['rroot'], fileName), destFilesStatus['blockSize'], destFilesStatus['size']))
         else:
-            filesToCreate.append(fileName)
+            filesToReplace.append(fileName)
+
+    # Same content with only modification time differing. Just fix the modification time
+    filesToTouch = []
+    if checksumCandidates:
+        identical = findIdenticalFiles(webHDFS, checksumCandidates, p)
+        for c in checksumCandidates:
+            if c[0] in identical:
+                filesToTouch.append(c[0])
+            else:
+                filesToReplace.append(c[0])
+    # Local file grew, and HDFS content is still its beginning. Just send the tail
+    filesToAppend = []
+    if appendCandidates:
+        appendable = findAppendableFiles(webHDFS, appendCandidates, p)
+        for c in appendCandidates:
+            if c[0] in appendable:
+                filesToAppend.append(c[0])
+            else:
+                filesToReplace.append(c[0])
 
     #print("directoriesToCreate:{0} filesToAdjust:{1} filesToCreate:{2} filesToReplace:{3}".format(directoriesToCreate, filesToAdjust, filesToCreate, filesToReplace))
     
-    for f in directoriesToCreate:
+    if directoriesToCreate:
         p.changed = True
+        with p.planLock:
+            (ops, newGroups) = planNewDirectories(directoriesToCreate, currentGroups, p)
         if not p.checkMode:
-            webHDFS.createFolder(f, p.directoryMode)
-            applyAttrOnNewDirectory(webHDFS, f, p)
+            executeOps(webHDFS, ops)
+        currentGroups.update(newGroups)
+    with p.planLock:
+        return planUpdates(webHDFS, srcTree, destTree, currentGroups, directoriesToAdjust, filesToAdjust, filesToTouch, filesToCreate, filesToAppend, filesToReplace, p)
+
 
+def planUpdates(webHDFS, srcTree, destTree, currentGroups, directoriesToAdjust, filesToAdjust, filesToTouch, filesToCreate, filesToAppend, filesToReplace, p):
+    # Group of each target directory once created or adjusted. New files will inherit it
+    groups = dict(currentGroups)
+    # Metadata only operations are independent from each other. Up to metadata_window of them are kept in flight
+    adjustments = []
     if p.forceExt:
         for f in directoriesToAdjust:
             p.changed = True
-            if not p.checkMode:
-                dirPath = os.path.join(destTree['rroot'], f)
-                dirStatus = destTree['directories'][f]
-                adjustAttrOnExistingDir(webHDFS, dirPath, dirStatus, p)
+            dirPath = os.path.join(destTree['rroot'], f)
+            dirStatus = destTree['directories'][f]
+            for op in planAdjustDir(dirPath, dirStatus, p):
+                adjustments.append((dirPath, executeOps, (webHDFS, [op])))
+            if p.group != None:
+                groups[dirPath] = p.group
     
         for f in filesToAdjust:
             p.changed = True
-            if not p.checkMode:
-                filePath = os.path.join(destTree['rroot'], f)
-                fileStatus = destTree['files'][f]
-                adjustAttrOnExistingFile(webHDFS, filePath, fileStatus, p)
+            filePath = os.path.join(destTree['rroot'], f)
+            fileStatus = destTree['files'][f]
+            for op in planAdjustFile(filePath, fileStatus, p):
+                adjustments.append((filePath, executeOps, (webHDFS, [op])))
+    for f in filesToTouch:
+        p.changed = True
+        filePath = os.path.join(destTree['rroot'], f)
+        ops = planTouchFile(filePath, srcTree['files'][f]['modificationTime'], destTree['files'][f], p)
+        for op in ops:
+            adjustments.append((filePath, executeOps, (webHDFS, [op])))
 
+    copies = []
     for f in filesToCreate:
         p.changed = True
+        srcPath = os.path.join(srcTree['rroot'], f)
+        destPath = os.path.join(destTree['rroot'], f)
+        modTime = srcTree['files'][f]['modificationTime']
+        ops = planNewFile(srcPath, destPath, modTime, p.force, False, groups.get(os.path.dirname(destPath)), p)
         if not p.checkMode:
-            srcPath = os.path.join(srcTree['rroot'], f)
-            destPath = os.path.join(destTree['rroot'], f)
-            webHDFS.putFileToHdfs(srcPath, destPath, p.force)
-            modTime = srcTree['files'][f]['modificationTime']
-            webHDFS.setModificationTime(destPath, modTime)
-            applyAttrOnNewFile(webHDFS, destPath, p)
+            copies.append((f, executeOps, (webHDFS, ops)))
+
+    for f in filesToAppend:
+        p.changed = True
+        srcPath = os.path.join(srcTree['rroot'], f)
+        destPath = os.path.join(destTree['rroot'], f)
+        ops = planAppendFile(srcPath, destPath, srcTree['files'][f]['modificationTime'], srcTree['files'][f]['size'], destTree['files'][f], p)
+        if not p.checkMode:
+            copies.append((f, executeOps, (webHDFS, ops)))
 
     if p.force:
         for f in filesToReplace:
             p.changed = True
+            srcPath = os.path.join(srcTree['rroot'], f)
+            destPath = os.path.join(destTree['rroot'], f)
+            modTime = srcTree['files'][f]['modificationTime']
+            ops = planNewFile(srcPath, destPath, modTime, p.force, p.backup, groups.get(os.path.dirname(destPath)), p)
             if not p.checkMode:
-                srcPath = os.path.join(srcTree['rroot'], f)
-                destPath = os.path.join(destTree['rroot'], f)
-                if p.backup:
-                    backupHdfsFile(webHDFS, destPath)
-                webHDFS.putFileToHdfs(srcPath, destPath, p.force)
-                modTime = srcTree['files'][f]['modificationTime']
-                webHDFS.setModificationTime(destPath, modTime)
-                applyAttrOnNewFile(webHDFS, destPath, p)
-    
+                copies.append((f, executeOps, (webHDFS, ops)))
+    return (adjustments, copies, groups)
 
 
 